@@ -0,0 +1,122 @@
+import asyncio
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from instrument import Instrument
+
+class AsyncInstrument(Instrument):
+    """
+    Instrument whose setup, sample and cleanup are coroutines
+
+    Instead of a thread each, any number of these share the event loop of
+    an AsyncEngine, which must be assigned to engine before start is
+    called. Blocking calls, such as VISA I/O, should be awaited through
+    run_blocking and waits through asyncio.sleep, so that the loop is free
+    for the other instruments in the meantime.
+    """
+    def __init__(self, queue_size=10000, queue_overflow='drop_oldest'):
+        super().__init__(queue_size, queue_overflow)
+        self.engine = None
+        self.task = None
+
+    async def setup(self):
+        """Override this to setup the instrument"""
+
+    async def sample(self):
+        """Override this to acquire/write a sample"""
+        return None
+
+    async def cleanup(self):
+        """Override this to close the instrument cleanly"""
+
+    async def run_blocking(self, fn, *args):
+        """Run a blocking call in the engine's executor"""
+        return await self.engine.run_blocking(fn, *args)
+
+    async def _run_async(self):
+        await self.setup()
+        try:
+            while self.running:
+                timer = self.latency.timer()
+                self.run_commands()
+                timer.lap('commands')
+                # Even unpaced, yield to the loop once a pass, or an instrument
+                # whose sample never awaits would starve all the others
+                await asyncio.sleep(self.scheduler.delay())
+                timer.lap('pace')
+                sample = await self.sample()
+                timer.lap('sample')
+                if sample is not None:
+                    # A blocking queue must not block the loop
+                    while (self.queue.overflow == 'block' and self.queue.full()
+                           and self.running):
+                        await asyncio.sleep(0.01)
+                    self.queue.put(sample, timeout=0)
+                    timer.lap('queue')
+        finally:
+            await self.cleanup()
+
+    def run_commands(self):
+        while True:
+            try:
+                command = self.commandqueue.get_nowait()
+            except queue.Empty:
+                break
+            command(self)
+
+    def start(self):
+        """Start the acquire loop on the engine"""
+        self.engine.add(self)
+
+    def stop(self):
+        """Stop the acquire loop, waiting for cleanup to finish"""
+        self.engine.remove(self)
+
+
+class AsyncEngine(object):
+    """
+    Event loop on a thread of its own, running AsyncInstruments
+
+    Blocking calls are run in a pool of at most max_workers threads, however
+    many instruments there are.
+    """
+    def __init__(self, max_workers=4):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def add(self, instrument):
+        """Start running the acquire loop of an instrument"""
+        if not self.thread.is_alive():
+            self.thread.start()
+        instrument.engine = self
+        instrument.running = True
+        instrument.task = asyncio.run_coroutine_threadsafe(instrument._run_async(),
+                                                           self.loop)
+
+    def remove(self, instrument):
+        """Stop an instrument, waiting for its acquire loop to finish"""
+        instrument.running = False
+        instrument.queue.close()
+        try:
+            instrument.task.result()
+        except Exception:
+            # As for an instrument thread, the error is only reported
+            traceback.print_exc()
+
+    async def run_blocking(self, fn, *args):
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    def stop(self):
+        """Stop the loop, after the instruments have been removed"""
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.loop.close()
+        self.executor.shutdown()
@@ -5,6 +5,9 @@ import os
 import os.path
 import itertools
 from datetime import datetime, timedelta, timezone
+from asyncengine import AsyncEngine, AsyncInstrument
+from instrumentprocess import InstrumentProcess
+from latency import format_summary
 
 class InstrumentException(Exception):
     pass
@@ -17,6 +20,9 @@ class Backend(object):
         self.data_logger = None
         self.logging = False
         self.config_dir = None
+        # Runs any async instruments, created when the first is started
+        self.engine = None
+        self.latency_log = None
 
     def set_config(self, value, directory):
         self.config = value
@@ -36,16 +42,44 @@ class Backend(object):
 
         for name, instcfg in self.config.instruments.items():
             driver_cls = self.instrument_drivers[type(instcfg)]
-            self.instruments[name] = driver_cls(instcfg)
+            if self.config.process_instruments:
+                self.instruments[name] = InstrumentProcess(driver_cls, instcfg)
+            else:
+                self.instruments[name] = driver_cls(instcfg)
 
         self.start_time = datetime.now(timezone.utc)
+        self.dropped = {}
         for name, inst in self.instruments.items():
+            if isinstance(inst, AsyncInstrument):
+                if self.engine is None:
+                    self.engine = AsyncEngine()
+                inst.engine = self.engine
             inst.start()
 
+        if self.config.align_phase:
+            # Deadlines of all instruments on one grid
+            origin = time.monotonic()
+            for inst in self.instruments.values():
+                inst.set_phase_origin(origin)
+
+        if self.config.latency_log:
+            path = os.path.normpath(os.path.join(self.config_dir, self.config.latency_log))
+            self.latency_log = open(path, 'a')
+            self.latency_time = time.monotonic()
+            for inst in self.instruments.values():
+                inst.enable_latency()
+
     def stop(self):
         for inst in self.instruments.values():
             inst.stop()
+        if self.latency_log is not None:
+            self.log_latency()
+            self.latency_log.close()
+            self.latency_log = None
         self.instruments = {}
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine = None
         if self.logging:
             self.stop_logging()
         self.data_logger = None
@@ -73,9 +107,30 @@ class Backend(object):
         for inst in self.instruments.values():
             inst.on_record_stop()
 
+    def log_latency(self):
+        """Write a line summarising the stage timings of each instrument"""
+        self.latency_time = time.monotonic()
+        now = datetime.now(timezone.utc).isoformat()
+        for name, inst in self.instruments.items():
+            summary = format_summary(inst.get_latency_stats())
+            if summary:
+                items = [summary, "missed deadlines {}".format(
+                    inst.get_schedule_stats()['missed'])]
+                items += ["{} {:g}".format(key, value)
+                          for key, value in sorted(inst.get_driver_stats().items())]
+                self.latency_log.write("{} {}: {}\n".format(now, name, "; ".join(items)))
+        self.latency_log.flush()
+
     def process_samples(self, fns):
+        if (self.latency_log is not None and
+                time.monotonic() - self.latency_time >= self.config.latency_interval):
+            self.log_latency()
         for name, inst in self.instruments.items():
             samples = inst.get_samples()
+            dropped = inst.get_queue_stats()['dropped']
+            if dropped > self.dropped.get(name, 0):
+                print("{} dropped {} samples".format(name, dropped - self.dropped.get(name, 0)))
+                self.dropped[name] = dropped
             if self.logging:
                 for s in samples:
                     if self.remaining_samples != 0 or name != self.config.master_instrument:
@@ -0,0 +1,53 @@
+"""
+Compare lorentz_fit throughput with and without the analytic Jacobian
+
+Sweeps are generated by the Simulated VNA model. Run from the repository
+root with:
+
+    python -m benchmarks.lorentz_fit [segments] [points] [repeats]
+"""
+import sys
+import time
+from vna.driver import Simulated, Segment, lorentz_fit, lorentz_jac
+
+
+def make_sweeps(segment_count, points, repeats):
+    model = Simulated(None)
+    model.setup(False)
+    centres = [2.5e9, 4.529e9]
+    segments = [Segment(str(i), centres[i % 2], 2e6, points)
+                for i in range(segment_count)]
+    model.set_segments(segments)
+
+    sweeps = []
+    for _ in range(repeats):
+        freq = model.get_freq_data()
+        ampl = model.get_sweep_data()[0]
+        start = 0
+        for seg in segments:
+            sweeps.append((freq[start:start+seg.points],
+                           ampl[start:start+seg.points]))
+            start += seg.points
+        time.sleep(0.01)
+    return sweeps
+
+
+def run(sweeps, jac):
+    start = time.perf_counter()
+    for freq, ampl in sweeps:
+        lorentz_fit(freq, ampl, jac=jac)
+    return len(sweeps)/(time.perf_counter() - start)
+
+
+def main(segment_count=8, points=801, repeats=25):
+    sweeps = make_sweeps(segment_count, points, repeats)
+    numeric = run(sweeps, None)
+    analytic = run(sweeps, lorentz_jac)
+    print("{} segments x {} points, {} sweeps".format(segment_count, points, repeats))
+    print("finite difference: {:8.1f} fits/s".format(numeric))
+    print("analytic:          {:8.1f} fits/s".format(analytic))
+    print("speedup:           {:8.2f}x".format(analytic/numeric))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,50 @@
+"""
+Compare ASCII and binary sweep data transfer from an E5071X
+
+The E5071X driver talks to a local simulated instrument from
+vna.simserver, so this measures the SCPI formatting and parsing costs
+rather than the instrument. Without NI-VISA installed, select the
+pyvisa-py backend with PYVISA_LIBRARY=@py. Run from the repository root
+with:
+
+    python -m benchmarks.sweep_transfer [points] [repeats]
+"""
+import sys
+import time
+from vna.config import Config
+from vna.driver import E5071X, Segment
+from vna.simserver import Server
+
+
+def run(resource, binary, points, repeats):
+    vna = E5071X(Config({
+        'model': 'E5071X',
+        'resource': resource,
+        'binary_transfer': binary
+    }))
+    vna.setup(False)
+    vna.set_segments([Segment('bench', 2.5e9, 2e6, points)])
+    vna.get_sweep_data()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        vna.get_sweep_data()
+    rate = repeats/(time.perf_counter() - start)
+    vna.cleanup()
+    return rate
+
+
+def main(points=1601, repeats=200):
+    server = Server(('127.0.0.1', 0))
+    server.start()
+    ascii_rate = run(server.resource, False, points, repeats)
+    binary_rate = run(server.resource, True, points, repeats)
+    server.shutdown()
+    print("{} point complex traces, {} reads".format(points, repeats))
+    print("ascii:  {:8.1f} traces/s".format(ascii_rate))
+    print("binary: {:8.1f} traces/s".format(binary_rate))
+    print("speedup: {:7.2f}x".format(binary_rate/ascii_rate))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,64 @@
+"""
+Measure the sample rate of vna.Driver against the simulated instrument
+
+The real E5071X or N5232A driver connects to a vna.simserver on a local
+port, so the whole SCPI and VISA path is exercised. Without NI-VISA
+installed, select the pyvisa-py backend with PYVISA_LIBRARY=@py. Run from
+the repository root with:
+
+    python -m benchmarks.vna_driver [--model M] [--seconds S]
+        [--latency S] [--point-time S] [--set key=value ...]
+
+Values given with --set override vna.Config fields, for example
+--set pipeline_sweeps=true --set fit_mode=batch.
+"""
+import argparse
+import json
+import time
+from vna.config import Config
+from vna.driver import Driver
+from vna.simserver import Server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--model', default='E5071X')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--latency', type=float, default=0.0005)
+    parser.add_argument('--point-time', type=float, default=20e-6)
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE')
+    args = parser.parse_args()
+
+    server = Server(('127.0.0.1', 0), args.latency, args.point_time)
+    server.start()
+
+    config = {
+        'model': args.model,
+        'resource': server.resource,
+        'segments': {
+            'TM010': {'f0': 2.5e9, 'span': 2e6, 'points': 401},
+            'TM020': {'f0': 4.529e9, 'span': 1.5e6, 'points': 401},
+        }
+    }
+    for item in args.set:
+        key, value = item.split('=', 1)
+        config[key] = json.loads(value)
+
+    driver = Driver(Config(config))
+    driver.start()
+    time.sleep(args.seconds)
+    driver.stop()
+    server.shutdown()
+
+    samples = driver.get_samples()
+    if len(samples) > 1:
+        duration = (samples[-1][0] - samples[0][0]).total_seconds()
+        rate = (len(samples)-1)/duration
+    else:
+        rate = 0.0
+    print("{}: {} samples, {:.1f} samples/s".format(args.model, len(samples), rate))
+
+
+if __name__ == '__main__':
+    main()
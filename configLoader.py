@@ -12,6 +12,14 @@ class ConfigLoader():
             samples = TList(TString())
             master_instrument = TString()
             flush_datafiles = TBool()
+            # Run each instrument driver in a process of its own
+            process_instruments = TBool()
+            # Sample every instrument on a common grid of deadlines
+            align_phase = TBool()
+            # File the stage timings of each instrument are summarised to,
+            # every latency_interval seconds, if set
+            latency_log = TString()
+            latency_interval = TFloat(60.0)
 
         self.schema = Configuration
 
@@ -4,3 +4,5 @@ class Config(TObject):
     type_ = TString("datalogger")
     serialPort = TString()
     model = TString("1365")
+    queue_size = TInt(10000)
+    queue_overflow = TString("drop_oldest")
@@ -6,7 +6,7 @@ UNEXPECTED_CLOSE_MSG = "Serial port closed unexpectedly"
 
 class Driver(Instrument):
     def __init__(self, config):
-        super().__init__()
+        super().__init__(int(config.queue_size), str(config.queue_overflow))
         self.config = config
 
     def setup(self):
@@ -14,10 +14,12 @@ class Driver(Instrument):
         self.res = serial.Serial(self.config.serialPort, timeout=3.0)
 
     def sample(self):
+        timer = self.latency.timer()
         sampletime = datetime.now(timezone.utc)
 
         if self.read_bytes(1)[0] != 0x02:
             return None
+        timer.lap('wait')
 
         
         if self.config.model == '1316':
@@ -38,6 +40,7 @@ class Driver(Instrument):
 
         if self.read_bytes(1)[0] != 0x03:
             return None
+        timer.lap('read')
 
         return sampletime, [ch0, ch1]
 
@@ -61,4 +64,13 @@ class Driver(Instrument):
             return ["Temperature (C)", "Relative Humidity (%)"]
 
     def format_sample(self, sample):
-        return sample
\ No newline at end of file
+        return sample
+
+    def sample_layout(self):
+        return 2, 0
+
+    def pack_sample(self, sample):
+        return sample, None
+
+    def unpack_sample(self, scalars, trace):
+        return scalars.tolist()
\ No newline at end of file
@@ -1,6 +1,9 @@
 import queue
 import threading
 import time
+from ringbuffer import RingBuffer
+from latency import LatencyRecorder, NULL_RECORDER
+from scheduler import DeadlineScheduler
 
 def get_resource_names(rm):
     resources = rm.list_resources()
@@ -38,12 +41,45 @@ class Wrapper(object):
     def close(self):
         self.res.close()
 
+def runlater(func=None, key=None, mirror=False):
+    """
+    Make a method run later in the acquire loop
+
+    Use as @runlater, or as @runlater(key=...) for commands where only the
+    latest call matters. key is a string, or a function of the method's
+    arguments returning the key, so that calls can be told apart by them.
+
+    With mirror=True, an instrument running in another process also applies
+    the call at once to its local copy, for methods that change what
+    get_headers or format_sample return.
+    """
+    def decorator(func):
+        def func_wrapper(self, *args, **kwargs):
+            self.runcmd(lambda self: func(self, *args, **kwargs),
+                        func_wrapper.get_key(*args, **kwargs))
+        # Lets an InstrumentProcess send the call by name
+        func_wrapper.runlater = func
+        func_wrapper.get_key = lambda *args, **kwargs: (
+            key(*args, **kwargs) if callable(key) else key)
+        func_wrapper.mirror = mirror
+        return func_wrapper
+    if func is None:
+        return decorator
+    return decorator(func)
+
 class Instrument(object):
-    def __init__(self):
-        self.queue = queue.Queue()
+    def __init__(self, queue_size=10000, queue_overflow='drop_oldest'):
+        self.queue = RingBuffer(queue_size, queue_overflow)
         self.running = False
         self.thread = threading.Thread(target=self._run)
         self.commandqueue = queue.Queue()
+        # Latest waiting command for each key
+        self.keyed_commands = {}
+        self.keyed_lock = threading.Lock()
+        # Stage timings, only recorded once enabled
+        self.latency = NULL_RECORDER
+        # Paces the acquire loop, drivers set an interval to use it
+        self.scheduler = DeadlineScheduler()
 
     def setup(self):
         """Override this to setup the instrument"""
@@ -63,17 +99,45 @@ class Instrument(object):
         """Override this for convert samples into a list for logging"""
         return []
 
+    def sample_layout(self):
+        """
+        Override this to return the (scalars, trace) sizes of packed samples
+
+        These are the most float64 values pack_sample ever returns in each
+        part, which fixes the record size when samples are passed between
+        processes. Samples that are pickled instead must fit in trace*8 bytes.
+        """
+        return 0, 512
+
+    def pack_sample(self, sample):
+        """
+        Override this to pack a sample into (scalars, trace) float64 arrays
+
+        trace may be None. Return None to pickle the sample instead.
+        """
+        return None
+
+    def unpack_sample(self, scalars, trace):
+        """Override this to rebuild a sample from the arrays of pack_sample"""
+        raise NotImplementedError()
+
     def _run(self):
         self.setup()
         while self.running:
+            timer = self.latency.timer()
             while True:
                 try:
                     self.commandqueue.get_nowait()(self) # Get and execute command
                 except queue.Empty:
                     break
+            timer.lap('commands')
+            self.scheduler.wait()
+            timer.lap('pace')
             sample = self.sample()
+            timer.lap('sample')
             if sample is not None:
                 self.queue.put(sample)
+                timer.lap('queue')
         self.cleanup()
 
     def start(self):
@@ -84,20 +148,60 @@ class Instrument(object):
     def stop(self):
         """Stop the acquire loop"""
         self.running = False
+        # A sample blocked on a full queue would otherwise never finish
+        self.queue.close()
         self.thread.join()
 
-    def runcmd(self, command):
-        self.commandqueue.put(command)
+    def runcmd(self, command, key=None):
+        """
+        Queue a command to run in the acquire loop
+
+        A command with a key replaces any waiting command with the same key,
+        keeping its place in the queue.
+        """
+        if key is None:
+            self.commandqueue.put(command)
+            return
+        with self.keyed_lock:
+            waiting = key in self.keyed_commands
+            self.keyed_commands[key] = command
+        if not waiting:
+            self.commandqueue.put(lambda self: self.run_keyed(key))
+
+    def run_keyed(self, key):
+        with self.keyed_lock:
+            command = self.keyed_commands.pop(key)
+        command(self)
 
     def get_samples(self):
         """Retrieve all collected samples from the sample queue"""
-        results = []
-        while True:
-            try:
-                results.append(self.queue.get_nowait())
-            except queue.Empty:
-                break
-        return results
+        return self.queue.drain()
+
+    def get_queue_stats(self):
+        """Return the size, count, added, dropped and high_water of the queue"""
+        return self.queue.get_stats()
+
+    @runlater(key='latency')
+    def enable_latency(self, enabled=True):
+        """Start or stop timing the stages of the acquire loop"""
+        self.latency = LatencyRecorder() if enabled else NULL_RECORDER
+
+    def get_latency_stats(self):
+        """Return count, mean, min, max and percentiles in seconds by stage"""
+        return self.latency.snapshot()
+
+    @runlater(key='phase_origin')
+    def set_phase_origin(self, origin):
+        """Align the sample deadlines to a time.monotonic() origin"""
+        self.scheduler.align(origin)
+
+    def get_schedule_stats(self):
+        """Return the interval, overrun policy and missed deadlines"""
+        return self.scheduler.get_stats()
+
+    def get_driver_stats(self):
+        """Override this to return a dict of counters kept by the driver"""
+        return {}
 
     def on_record_start(self):
         """Called when datalogging has started"""
@@ -107,11 +211,6 @@ class Instrument(object):
         """Called when datalogging has stopped"""
         pass
 
-def runlater(func):
-    def func_wrapper(self, *args, **kwargs):
-        self.runcmd(lambda self: func(self, *args, **kwargs))
-    return func_wrapper
-
 class DataWindow(object):
 
     def start(self):
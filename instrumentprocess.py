@@ -0,0 +1,439 @@
+import atexit
+import collections
+import multiprocessing
+import pickle
+import queue
+import time
+import traceback
+from datetime import datetime, timezone
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from asyncengine import AsyncEngine, AsyncInstrument
+from ringbuffer import OVERFLOW_POLICIES
+
+# Counters at the start of the shared memory block
+WRITTEN, READ, ADDED, DROPPED, HIGH_WATER, CLOSED = range(6)
+COUNTERS = 6
+
+PACKED, PICKLED = 0, 1
+
+# Forking a process with the GUI running is unsafe, and spawning is the only
+# choice on Windows anyway
+context = multiprocessing.get_context('spawn')
+
+class SampleRing(object):
+    """
+    Ring of fixed size sample records in shared memory
+
+    One process puts samples and another drains them. Each record holds the
+    sample time and up to scalars float64 values. Its trace region of trace
+    float64 values, which also holds samples that are pickled instead, is in
+    a ring of traces slots of its own, which may be shorter. Unless blocking,
+    the oldest traces are overwritten to make room, and a record drained
+    after its trace was overwritten comes without one, or is dropped if it
+    was pickled. The overflow policies and statistics are otherwise those of
+    RingBuffer.
+    """
+    def __init__(self, size, scalars, trace, overflow='drop_oldest',
+                 traces=None, name=None, lock=None):
+        if size < 1:
+            raise ValueError("Ring buffer size must be at least 1")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '{}'".format(overflow))
+        self.size = size
+        self.scalars = scalars
+        self.trace = trace
+        self.traces = size if traces is None else max(1, min(traces, size))
+        self.overflow = overflow
+        self.dtype = np.dtype([('time', 'f8'), ('kind', 'i8'),
+                               ('scalar_count', 'i8'), ('trace_bytes', 'i8'),
+                               ('scalars', 'f8', (scalars,))])
+        # Each slot holds the number of the record its trace belongs to
+        self.trace_dtype = np.dtype([('record', 'i8'), ('trace', 'u1', (trace*8,))])
+        offset = COUNTERS*8 + size*self.dtype.itemsize
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=offset + self.traces*self.trace_dtype.itemsize)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.counters = np.ndarray((COUNTERS,), np.int64, self.shm.buf)
+        self.records = np.ndarray((size,), self.dtype, self.shm.buf, COUNTERS*8)
+        self.trace_slots = np.ndarray((self.traces,), self.trace_dtype,
+                                      self.shm.buf, offset)
+        if self.owner:
+            self.counters[:] = 0
+            self.trace_slots['record'] = -1
+        self.lock = lock or context.Lock()
+
+    def attach_args(self):
+        """Arguments for a SampleRing on the same memory in another process"""
+        return (self.size, self.scalars, self.trace, self.overflow,
+                self.traces, self.shm.name, self.lock)
+
+    def __len__(self):
+        return int(self.counters[WRITTEN] - self.counters[READ])
+
+    def full(self):
+        return len(self) >= self.size
+
+    def put(self, sampletime, kind, scalars, trace, timeout=None):
+        """Add a record, returns False if a record was dropped instead"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        counters = self.counters
+        # Blocking also waits for unread traces rather than overwrite them
+        limit = self.size
+        if trace and self.overflow == 'block':
+            limit = self.traces
+        while True:
+            with self.lock:
+                if len(self) >= limit:
+                    if self.overflow == 'drop_oldest':
+                        counters[READ] += 1
+                        counters[DROPPED] += 1
+                    elif self.overflow == 'drop_newest' or self.closed:
+                        counters[DROPPED] += 1
+                        return False
+                if len(self) < limit:
+                    written = int(counters[WRITTEN])
+                    n = written % self.size
+                    records = self.records
+                    records['time'][n] = sampletime
+                    records['kind'][n] = kind
+                    records['scalar_count'][n] = len(scalars)
+                    records['scalars'][n, :len(scalars)] = scalars
+                    records['trace_bytes'][n] = len(trace)
+                    if trace:
+                        slot = written % self.traces
+                        self.trace_slots['record'][slot] = written
+                        self.trace_slots['trace'][slot, :len(trace)] = np.frombuffer(trace, np.uint8)
+                    counters[WRITTEN] += 1
+                    counters[ADDED] += 1
+                    counters[HIGH_WATER] = max(counters[HIGH_WATER], len(self))
+                    return True
+            # Blocking, there is no condition shared between processes
+            if deadline is not None and time.monotonic() >= deadline:
+                with self.lock:
+                    counters[DROPPED] += 1
+                return False
+            time.sleep(0.001)
+
+    def drain(self):
+        """
+        Remove and return all records as (time, kind, scalars, trace bytes)
+
+        The trace is None if it has been overwritten since.
+        """
+        items = []
+        with self.lock:
+            first, last = int(self.counters[READ]), int(self.counters[WRITTEN])
+            for n in range(first, last):
+                r = self.records[n % self.size]
+                trace = b''
+                if r['trace_bytes']:
+                    slot = self.trace_slots[n % self.traces]
+                    if slot['record'] == n:
+                        trace = slot['trace'][:r['trace_bytes']].tobytes()
+                    elif r['kind'] == PICKLED:
+                        # Nothing is left of the sample
+                        self.counters[DROPPED] += 1
+                        continue
+                    else:
+                        trace = None
+                items.append((float(r['time']), int(r['kind']),
+                              r['scalars'][:r['scalar_count']].copy(), trace))
+            self.counters[READ] = last
+        return items
+
+    def close(self):
+        """Stop a blocked put from waiting, as for RingBuffer"""
+        self.counters[CLOSED] = 1
+
+    @property
+    def closed(self):
+        return bool(self.counters[CLOSED])
+
+    def get_stats(self):
+        with self.lock:
+            return {'size': self.size, 'count': len(self),
+                    'added': int(self.counters[ADDED]),
+                    'dropped': int(self.counters[DROPPED]),
+                    'high_water': int(self.counters[HIGH_WATER])}
+
+    def release(self):
+        """Unmap the memory, removing it if this ring created it"""
+        del self.counters, self.records, self.trace_slots
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SampleWriter(object):
+    """Stands in for Instrument.queue in the worker process"""
+    def __init__(self, ring, instrument):
+        self.ring = ring
+        self.instrument = instrument
+        self.overflow = ring.overflow
+
+    def full(self):
+        # Nothing waits for room once closed, as for RingBuffer
+        return self.ring.full() and not self.ring.closed
+
+    def put(self, item, timeout=None):
+        sampletime, sample = item
+        packed = self.instrument.pack_sample(sample)
+        if packed is None:
+            kind, scalars, trace = PICKLED, (), pickle.dumps(sample)
+        else:
+            kind, (scalars, trace) = PACKED, packed
+            scalars = np.asarray(scalars, dtype=float)
+            trace = b'' if trace is None else np.asarray(trace, dtype=float).tobytes()
+        if len(scalars) > self.ring.scalars or len(trace) > self.ring.trace*8:
+            print("Sample too large for the shared memory ring, dropped")
+            return False
+        return self.ring.put(sampletime.timestamp(), kind, scalars, trace, timeout)
+
+    def close(self):
+        self.ring.close()
+
+
+class PipeCommandQueue(object):
+    """
+    Stands in for Instrument.commandqueue in the worker process
+
+    Commands arrive from the InstrumentProcess through a pipe. Keyed commands
+    replace any waiting command with the same key, as in Instrument.runcmd.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        # [key, command] pairs
+        self.waiting = collections.deque()
+        self.closed = False
+
+    def receive(self, timeout=0.0):
+        if self.closed:
+            return
+        try:
+            while self.conn.poll(timeout):
+                timeout = 0.0
+                self.add(*self.decode(self.conn.recv()))
+        except (EOFError, OSError):
+            # The parent has gone away
+            self.closed = True
+            self.add(None, stop_instrument)
+
+    def decode(self, message):
+        kind = message[0]
+        if kind == 'stop':
+            return None, stop_instrument
+        if kind == 'stats':
+            return 'stats', lambda inst: send_stats(self.conn, inst)
+        if kind == 'call':
+            name, args, kwargs, key = message[1:]
+            return key, lambda inst: getattr(type(inst), name).runlater(inst, *args, **kwargs)
+        command, key = message[1:]
+        return key, command
+
+    def add(self, key, command):
+        if key is not None:
+            for entry in self.waiting:
+                if entry[0] == key:
+                    entry[1] = command
+                    return
+        self.waiting.append([key, command])
+
+    def put(self, command):
+        self.add(None, command)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get(self, block=True, timeout=None):
+        self.receive()
+        if not self.waiting and block:
+            self.receive(timeout)
+        if not self.waiting:
+            raise queue.Empty
+        return self.waiting.popleft()[1]
+
+    def empty(self):
+        self.receive()
+        return not self.waiting
+
+
+def stop_instrument(inst):
+    inst.running = False
+
+def send_stats(conn, inst):
+    conn.send(('stats', inst.get_latency_stats(), inst.get_schedule_stats(),
+               inst.get_driver_stats()))
+
+def run_instrument(driver_cls, config_cls, config_data, conn, ring_args):
+    """Entry point of the worker process"""
+    ring = SampleRing(*ring_args)
+    inst = driver_cls(config_cls(config_data))
+    inst.commandqueue = PipeCommandQueue(conn)
+    inst.queue = SampleWriter(ring, inst)
+    try:
+        if isinstance(inst, AsyncInstrument):
+            engine = AsyncEngine()
+            engine.add(inst)
+            try:
+                # Until stopped through the pipe
+                inst.task.result()
+            finally:
+                engine.stop()
+        else:
+            inst.running = True
+            inst._run()
+    except Exception:
+        traceback.print_exc()
+    finally:
+        # Final stats, for the summary when the instruments are stopped
+        try:
+            send_stats(conn, inst)
+        except (EOFError, OSError):
+            pass
+        ring.release()
+        conn.close()
+
+
+class InstrumentProcess(object):
+    """
+    Runs an instrument driver in a process of its own
+
+    It presents the Instrument API to the GUI and Backend. Samples come back
+    through a SampleRing. Commands go through a pipe, so they must be
+    picklable, and methods decorated with runlater are sent by name. A local,
+    never started, instance of the driver answers everything else, such as
+    cfg, get_headers and format_sample.
+
+    The ring only has to hold the samples between two calls of get_samples,
+    so it is shorter than the queue_size of the driver, and its traces take
+    at most trace_memory bytes. Only the traces of the latest samples are
+    kept when they would take more.
+    """
+    stop_timeout = 30.0
+    queue_size = 500
+    trace_memory = 16*2**20
+
+    def __init__(self, driver_cls, config):
+        self.driver_cls = driver_cls
+        self.local = driver_cls(config)
+        scalars, trace = self.local.sample_layout()
+        self.ring = SampleRing(min(int(config.queue_size), self.queue_size),
+                               scalars, trace, str(config.queue_overflow),
+                               self.trace_memory//max(trace*8, 1))
+        self.conn, self.child_conn = context.Pipe()
+        # Last stage timings, schedule and driver stats the worker sent back
+        self.latency_stats = {}
+        self.schedule_stats = self.local.get_schedule_stats()
+        self.driver_stats = self.local.get_driver_stats()
+        # Not a daemon, as the driver may start a pool of its own. Should the
+        # GUI exit without stopping it, the worker stops when the pipe closes
+        self.process = context.Process(
+            target=run_instrument,
+            args=(driver_cls, type(config), config.serialize(), self.child_conn,
+                  self.ring.attach_args()))
+
+    def start(self):
+        """Start the worker process"""
+        self.process.start()
+        self.child_conn.close()
+        # multiprocessing joins the worker at exit, so it must see the pipe
+        # close first
+        atexit.register(self.conn.close)
+
+    def stop(self):
+        """Stop the worker process, waiting for its cleanup to finish"""
+        try:
+            self.conn.send(('stop',))
+        except (BrokenPipeError, OSError):
+            pass
+        self.ring.close()
+        # Commands, and so stop, are only seen between samples
+        self.process.join(self.stop_timeout)
+        if self.process.is_alive():
+            print("Instrument process did not stop, terminating it")
+            self.process.terminate()
+            self.process.join()
+        self.collect_stats()
+        atexit.unregister(self.conn.close)
+        self.conn.close()
+        self.ring.release()
+
+    def runcmd(self, command, key=None):
+        """Queue a command to run in the acquire loop of the worker"""
+        self.conn.send(('command', command, key))
+
+    def get_samples(self):
+        """Retrieve all collected samples from the shared memory ring"""
+        samples = []
+        for sampletime, kind, scalars, trace in self.ring.drain():
+            sampletime = datetime.fromtimestamp(sampletime, timezone.utc)
+            if kind == PICKLED:
+                sample = pickle.loads(trace)
+            else:
+                sample = self.local.unpack_sample(
+                    scalars, np.frombuffer(trace, np.float64) if trace else None)
+            samples.append((sampletime, sample))
+        return samples
+
+    def get_queue_stats(self):
+        """Return the size, count, added, dropped and high_water of the ring"""
+        return self.ring.get_stats()
+
+    def collect_stats(self):
+        """Keep the stats the worker has sent since the last call"""
+        try:
+            while self.conn.poll():
+                reply = self.conn.recv()
+                if reply[0] == 'stats':
+                    self.latency_stats, self.schedule_stats, self.driver_stats = reply[1:]
+        except (EOFError, OSError):
+            pass
+
+    def request_stats(self):
+        """
+        Collect the stats last sent by the worker and ask for them anew
+
+        So while running, the stats returned are a call behind. Once stopped
+        they are the worker's final ones.
+        """
+        self.collect_stats()
+        try:
+            self.conn.send(('stats',))
+        except (EOFError, OSError):
+            pass
+
+    def get_latency_stats(self):
+        self.request_stats()
+        return self.latency_stats
+
+    def get_schedule_stats(self):
+        self.request_stats()
+        return self.schedule_stats
+
+    def get_driver_stats(self):
+        self.request_stats()
+        return self.driver_stats
+
+    def get_headers(self):
+        return self.local.get_headers()
+
+    def format_sample(self, sample):
+        return self.local.format_sample(sample)
+
+    def __getattr__(self, name):
+        method = getattr(self.driver_cls, name, None)
+        runlater = getattr(method, 'runlater', None)
+        if runlater is None:
+            return getattr(self.local, name)
+        def forward(*args, **kwargs):
+            self.conn.send(('call', name, args, kwargs,
+                            method.get_key(*args, **kwargs)))
+            if method.mirror:
+                runlater(self.local, *args, **kwargs)
+        return forward
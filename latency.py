@@ -0,0 +1,121 @@
+import math
+import time
+
+class LatencyHistogram(object):
+    """
+    Durations counted in log-spaced bins, in fixed memory
+
+    The bins run from min_time over decades decades, with bins_per_decade in
+    each, plus one bin either side for anything shorter or longer.
+    Percentiles are given as the upper edge of their bin, so to within a
+    quarter of their value at 10 bins per decade.
+    """
+    min_time = 1e-6
+    decades = 8
+    bins_per_decade = 10
+
+    def __init__(self):
+        self.counts = [0]*(self.decades*self.bins_per_decade + 2)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds < self.min_time:
+            index = 0
+        else:
+            index = min(int(math.log10(seconds/self.min_time)*self.bins_per_decade) + 1,
+                        len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        target = fraction*self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                edge = self.min_time*10.0**(index/self.bins_per_decade)
+                return min(max(edge, self.min), self.max)
+        return self.max
+
+    def snapshot(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.total/self.count,
+                'min': self.min, 'max': self.max, 'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9), 'p99': self.percentile(0.99)}
+
+
+class LatencyRecorder(object):
+    """Histogram of the durations of each named stage of an acquire loop"""
+    def __init__(self):
+        self.histograms = {}
+
+    def add(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.add(seconds)
+
+    def timer(self):
+        return LapTimer(self)
+
+    def snapshot(self):
+        """Return count, mean, min, max, p50, p90 and p99 in seconds by stage"""
+        return {stage: histogram.snapshot()
+                for stage, histogram in list(self.histograms.items())}
+
+
+class LapTimer(object):
+    """Times consecutive stages, each lap ending the stage before it"""
+    __slots__ = ('recorder', 'last')
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.recorder.add(stage, now - self.last)
+        self.last = now
+
+
+class NullRecorder(object):
+    """Stands in for a LatencyRecorder when timing is disabled"""
+    def add(self, stage, seconds):
+        pass
+
+    def timer(self):
+        return NULL_TIMER
+
+    def snapshot(self):
+        return {}
+
+
+class NullTimer(object):
+    __slots__ = ()
+
+    def lap(self, stage):
+        pass
+
+
+NULL_RECORDER = NullRecorder()
+NULL_TIMER = NullTimer()
+
+def format_summary(snapshot):
+    """One line summary of a LatencyRecorder snapshot, in milliseconds"""
+    items = []
+    for stage, stats in sorted(snapshot.items()):
+        if not stats['count']:
+            continue
+        items.append("{} n={} mean={:.3f} p50={:.3f} p90={:.3f} p99={:.3f} max={:.3f}".format(
+            stage, stats['count'], stats['mean']*1e3, stats['p50']*1e3,
+            stats['p90']*1e3, stats['p99']*1e3, stats['max']*1e3))
+    return "; ".join(items)
@@ -2,6 +2,7 @@ from PyQt5 import QtWidgets, QtCore
 from PyQt5.QtGui import QIcon
 from utils import getResourcePath
 import sys
+import multiprocessing
 import uis
 from backend import Backend
 from configLoader import ConfigLoader
@@ -66,4 +67,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # Needed for fit worker processes in frozen builds
+    multiprocessing.freeze_support()
     main()
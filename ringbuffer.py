@@ -0,0 +1,78 @@
+import collections
+import threading
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+class RingBuffer(object):
+    """
+    Bounded FIFO for passing samples between threads, drained in bulk
+
+    When full, put either waits for room ('block'), discards the oldest item
+    to make room ('drop_oldest') or discards the new item ('drop_newest').
+    Dropped items are counted, as is the most items ever held at once.
+    """
+    def __init__(self, size, overflow='drop_oldest'):
+        if size < 1:
+            raise ValueError("Ring buffer size must be at least 1")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '{}'".format(overflow))
+        self.size = size
+        self.overflow = overflow
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+        self.added = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def full(self):
+        return len(self.items) >= self.size
+
+    def put(self, item, timeout=None):
+        """Add an item, returns False if an item was dropped instead"""
+        with self.lock:
+            if len(self.items) >= self.size:
+                if self.overflow == 'block':
+                    self.not_full.wait_for(
+                        lambda: self.closed or len(self.items) < self.size, timeout)
+                    if len(self.items) >= self.size:
+                        # Closed or timed out
+                        self.dropped += 1
+                        return False
+                elif self.overflow == 'drop_oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return False
+            self.items.append(item)
+            self.added += 1
+            self.high_water = max(self.high_water, len(self.items))
+            return True
+
+    def drain(self, limit=None):
+        """Remove and return all items, or the oldest limit items"""
+        with self.lock:
+            if limit is None or limit >= len(self.items):
+                items = list(self.items)
+                self.items.clear()
+            else:
+                items = [self.items.popleft() for i in range(limit)]
+            self.not_full.notify_all()
+        return items
+
+    def close(self):
+        """Wake any blocked put, after which items that do not fit are dropped"""
+        with self.lock:
+            self.closed = True
+            self.not_full.notify_all()
+
+    def get_stats(self):
+        with self.lock:
+            return {'size': self.size, 'count': len(self.items),
+                    'added': self.added, 'dropped': self.dropped,
+                    'high_water': self.high_water}
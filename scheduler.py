@@ -0,0 +1,71 @@
+import math
+import time
+
+OVERRUN_POLICIES = ('skip', 'catchup', 'rephase')
+
+class DeadlineScheduler(object):
+    """
+    Paces a loop to deadlines every interval seconds on the monotonic clock
+
+    The deadlines lie on a grid starting at origin, so they do not drift
+    however long each pass takes, and loops aligned to the same origin stay
+    in phase. When a pass overruns its deadline, 'skip' waits for the next
+    deadline still ahead, 'catchup' runs at once for every deadline missed
+    until back on time, and 'rephase' runs at once and starts a new grid from
+    then. Missed deadlines are counted. An interval of 0 never waits.
+
+    Without an origin, the first pass starts at once and sets the grid.
+    """
+    def __init__(self, interval=0.0, overrun='skip', origin=None):
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError("Unknown overrun policy '{}'".format(overrun))
+        self.interval = interval
+        self.overrun = overrun
+        self.deadline = None
+        self.missed = 0
+        if origin is not None:
+            self.align(origin)
+
+    def align(self, origin):
+        """Move the grid to start at origin, from the next deadline on"""
+        if self.interval > 0.0:
+            passed = math.ceil((time.monotonic() - origin)/self.interval)
+            self.deadline = origin + max(passed, 0)*self.interval
+
+    def delay(self):
+        """Take the next deadline, returning the time to wait for it"""
+        if self.interval <= 0.0:
+            return 0.0
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now + self.interval
+            return 0.0
+        wait = self.deadline - now
+        if wait >= 0.0:
+            self.deadline += self.interval
+            return wait
+        # This deadline and any others since have been missed
+        missed = int(-wait//self.interval) + 1
+        if self.overrun == 'skip':
+            self.missed += missed
+            self.deadline += missed*self.interval
+            wait = self.deadline - now
+            self.deadline += self.interval
+            return wait
+        if self.overrun == 'catchup':
+            self.missed += 1
+            self.deadline += self.interval
+        else:
+            self.missed += missed
+            self.deadline = now + self.interval
+        return 0.0
+
+    def wait(self):
+        """Sleep until the next deadline, call this before each pass"""
+        delay = self.delay()
+        if delay > 0.0:
+            time.sleep(delay)
+
+    def get_stats(self):
+        return {'interval': self.interval, 'overrun': self.overrun,
+                'missed': self.missed}
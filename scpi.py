@@ -11,6 +11,14 @@ def get_resource_names(rm):
 def onoff(b):
     return "ON" if b else "OFF"
 
+def open_resource(rm, name):
+    """Open a VISA resource, terminating lines on raw sockets"""
+    res = rm.open_resource(name)
+    if name.upper().endswith("::SOCKET"):
+        res.read_termination = "\n"
+        res.write_termination = "\n"
+    return res
+
 class Wrapper(object):
     def __init__(self, resource):
         self.res = resource
@@ -24,6 +32,19 @@ class Wrapper(object):
     def query_ascii_values(self, cmd, *args, **kwargs):
         return self.res.query_ascii_values(cmd.format(*args, **kwargs))
 
+    def query_binary_values(self, cmd, *args, datatype='d', is_big_endian=True,
+                            container=list, **kwargs):
+        return self.res.query_binary_values(cmd.format(*args, **kwargs),
+                                            datatype=datatype,
+                                            is_big_endian=is_big_endian,
+                                            container=container)
+
+    def write_binary_values(self, cmd, data, *args, datatype='d',
+                            is_big_endian=True, **kwargs):
+        self.res.write_binary_values(cmd.format(*args, **kwargs) + " ", data,
+                                     datatype=datatype,
+                                     is_big_endian=is_big_endian)
+
     def write_ascii_values(self, cmd, data, *args, **kwargs):
         self.res.write(cmd.format(*args, **kwargs) + " " + ",".join([repr(x) for x in data]))
         #self.res.write_ascii_values(cmd.format(*args, **kwargs), data)
@@ -31,6 +52,25 @@ class Wrapper(object):
     def write(self, cmd, *args, **kwargs):
         self.res.write(cmd.format(*args, **kwargs))
 
+    def enable_srq(self):
+        """
+        Queue service request events for wait_for_srq
+
+        Returns False if the resource cannot, e.g. a raw socket.
+        """
+        from pyvisa.constants import EventType, EventMechanism
+        from pyvisa.errors import VisaIOError
+        try:
+            self.res.enable_event(EventType.service_request, EventMechanism.queue)
+        except (AttributeError, NotImplementedError, VisaIOError):
+            return False
+        return True
+
+    def wait_for_srq(self, timeout=25000):
+        # Resource.wait_for_srq only exists for GPIB, events work on LAN and USB too
+        from pyvisa.constants import EventType
+        self.res.wait_on_event(EventType.service_request, timeout)
+
     def close(self):
         self.res.close()
 
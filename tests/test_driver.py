@@ -0,0 +1,149 @@
+"""
+Tests of vna.Driver against the Simulated model, run from the repository
+root with:
+
+    python -m pytest tests
+"""
+import time
+from datetime import datetime, timezone
+import numpy as np
+import pytest
+
+from vna.config import Config
+from vna.driver import Driver, Segment, SweepBudget
+
+
+def make_config(**config):
+    return Config(dict({
+        'model': 'simulated',
+        'segments': {
+            'TM010': {'f0': 2.5e9, 'span': 2e6, 'points': 201},
+            'TM020': {'f0': 4.529e9, 'span': 1.5e6, 'points': 201},
+        }
+    }, **config))
+
+
+@pytest.mark.parametrize('pipelined', [False, True], ids=['serial', 'pipelined'])
+def test_retracked_tag_matches_swept_axis(pipelined):
+    driver = Driver(make_config(pipeline_sweeps=pipelined, retrack_sweep=False))
+    driver.setup()
+    samples = []
+    try:
+        for i in range(40):
+            if i % 7 == 3:
+                driver.forced_retrack = True
+            sample = driver.sample()
+            if sample is not None:
+                samples.append(sample)
+            samples.extend(driver.queue.drain())
+    finally:
+        driver.cleanup()
+    samples.extend(driver.queue.drain())
+
+    # A sample is tagged retracked exactly when it was swept over a
+    # different frequency axis to the one before it
+    changes = 0
+    previous = None
+    for t, sample in samples:
+        changed = (previous is not None
+                   and not np.array_equal(previous, sample.trace_freq))
+        assert sample.retracked == changed
+        changes += changed
+        previous = sample.trace_freq
+    assert changes > 0
+
+
+def test_state_holds_plain_values():
+    # Schedule stats are sent between processes, and the schema types would
+    # take the whole configuration tree with them
+    driver = Driver(make_config(sample_interval=0.02))
+    assert type(driver.scheduler.get_stats()['interval']) is float
+    assert type(driver.cfg.track_freq) is bool
+    assert type(driver.cfg.bw_factor) is float
+
+
+def test_lost_fits_of_one_window_nudge_once():
+    driver = Driver(make_config(search_span=0.0))
+    driver.setup()
+    try:
+        cplx, freq = driver.read_sweep()
+        ampl = np.sqrt(cplx[0]**2 + cplx[1]**2)
+        layout = [(entry[0], None) for entry in driver.table]
+        before = [(seg.f0, seg.span) for seg in driver.cfg.segments]
+        # Several lost fits of the same sweep, as collect_fits can pick up
+        # from the worker pool in one call
+        for i in range(4):
+            fits = [None]*len(layout)
+            assert driver.process_fits(freq, ampl, layout, fits,
+                                       driver.generation) is None
+    finally:
+        driver.cleanup()
+    for seg, (f0, span) in zip(driver.cfg.segments, before):
+        assert abs(seg.f0 - f0) == pytest.approx(span)
+
+
+def test_pipelined_samples_stamped_when_swept():
+    driver = Driver(make_config(pipeline_sweeps=True, sample_interval=0.1))
+    driver.setup()
+    try:
+        for i in range(5):
+            # The next sweep was started before the wait for the deadline
+            swept = datetime.now(timezone.utc)
+            driver.scheduler.wait()
+            sampletime, data = driver.sample()
+            assert sampletime <= swept
+    finally:
+        driver.cleanup()
+
+
+def test_predictive_tracking_follows_a_step():
+    driver = Driver(make_config(track_mode='predictive'))
+    driver.setup()
+    step = [0.0]
+    driver.driver.frequencies[0] = lambda t: 2.5e9 + step[0]
+    driver.driver.bandwidths[0] = lambda t: 200e3
+    try:
+        for i in range(10):
+            driver.sample()
+        forced = driver.retrack_stats['forced_sweeps']
+        # Such as a sample being inserted, a step is not a drift to follow
+        step[0] = 900e3
+        for i in range(20):
+            driver.sample()
+    finally:
+        driver.cleanup()
+    assert driver.retrack_stats['forced_sweeps'] - forced == 1
+    assert driver.cfg.segments[0].f0 == pytest.approx(2.5009e9, abs=20e3)
+
+
+def test_retrack_time_includes_upload():
+    driver = Driver(make_config(retrack_sweep=False))
+    driver.setup()
+    write_segments = driver.driver.write_segments
+    def slow_write(rows, channel=1):
+        time.sleep(0.05)
+        write_segments(rows, channel)
+    driver.driver.write_segments = slow_write
+    try:
+        driver.forced_retrack = True
+        driver.sample()
+        # The new window is only sent before the next sweep
+        driver.sample()
+    finally:
+        driver.cleanup()
+    assert driver.retrack_stats['retracks'] >= 1
+    assert driver.retrack_stats['forced_sweeps'] == 0
+    assert driver.retrack_stats['time'] >= 0.05
+
+
+def test_budget_rounds_ifbw_to_instrument_steps():
+    budget = SweepBudget(10.0)
+    segments = [Segment('TM010', 2.5e9, 2e6, 201, 1e3)]
+    budget.scale = 0.75
+    budget.apply(segments)
+    # 1e3*201/151 Hz is not an IF bandwidth the instrument can set
+    assert segments[0].points == 151
+    assert segments[0].ifbw == 1.5e3
+    budget.scale = 1.0
+    budget.apply(segments)
+    assert segments[0].ifbw == 1e3
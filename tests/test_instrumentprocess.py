@@ -0,0 +1,80 @@
+"""
+Tests of the shared memory ring between instrument processes, run from the
+repository root with:
+
+    python -m pytest tests
+"""
+import pickle
+import numpy as np
+import pytest
+
+from instrumentprocess import SampleRing, InstrumentProcess, PACKED, PICKLED
+from vna.config import Config
+from vna.driver import Driver
+
+
+@pytest.fixture
+def make_ring():
+    rings = []
+    def make(*args, **kwargs):
+        ring = SampleRing(*args, **kwargs)
+        rings.append(ring)
+        return ring
+    yield make
+    for ring in rings:
+        ring.release()
+
+
+def trace_bytes(value, count=4):
+    return np.full(count, value, dtype=float).tobytes()
+
+
+def test_only_latest_traces_kept(make_ring):
+    ring = make_ring(8, 2, 4, traces=3)
+    for i in range(6):
+        assert ring.put(float(i), PACKED, [i, i], trace_bytes(i))
+    items = ring.drain()
+    # Every record is kept, with the traces of the last three
+    assert [t for t, kind, scalars, trace in items] == list(range(6))
+    assert [trace for t, kind, scalars, trace in items[:3]] == [None]*3
+    for i, (t, kind, scalars, trace) in enumerate(items[3:], 3):
+        assert list(scalars) == [i, i]
+        assert trace == trace_bytes(i)
+    assert ring.get_stats()['dropped'] == 0
+
+
+def test_pickled_sample_dropped_with_its_trace(make_ring):
+    ring = make_ring(8, 0, 64, traces=2)
+    for i in range(3):
+        ring.put(float(i), PICKLED, (), pickle.dumps(i))
+    items = ring.drain()
+    assert [pickle.loads(trace) for t, kind, scalars, trace in items] == [1, 2]
+    assert ring.get_stats()['dropped'] == 1
+
+
+def test_blocking_waits_for_unread_traces(make_ring):
+    ring = make_ring(8, 1, 4, 'block', traces=2)
+    assert ring.put(0.0, PACKED, [0], trace_bytes(0))
+    assert ring.put(1.0, PACKED, [1], trace_bytes(1))
+    assert not ring.put(2.0, PACKED, [2], trace_bytes(2), timeout=0.01)
+    # Records without a trace only wait for the ring itself
+    assert ring.put(3.0, PACKED, [3], b'')
+    items = ring.drain()
+    assert [trace for t, kind, scalars, trace in items] == [
+        trace_bytes(0), trace_bytes(1), b'']
+
+
+def test_process_ring_size():
+    segments = {'S{}'.format(i): {'f0': 2.5e9 + i*1e8, 'points': 801}
+                for i in range(8)}
+    inst = InstrumentProcess(Driver, Config({'model': 'simulated',
+                                             'segments': segments}))
+    try:
+        ring = inst.ring
+        assert ring.size == InstrumentProcess.queue_size
+        assert ring.traces*ring.trace*8 <= InstrumentProcess.trace_memory
+        assert ring.shm.size < 2*InstrumentProcess.trace_memory
+    finally:
+        inst.ring.release()
+        inst.conn.close()
+        inst.child_conn.close()
@@ -0,0 +1,190 @@
+"""
+Regression tests for the E5071X and N5232A drivers against vna.simserver
+
+Each test starts a server on a free local port and connects the real driver
+to it, so the SCPI commands, the ASCII and binary transfers and the sweep
+completion are all exercised. Run from the repository root with:
+
+    python -m pytest tests
+
+Without NI-VISA installed, the pyvisa-py backend is selected.
+"""
+import os
+import time
+import numpy as np
+import pytest
+
+os.environ.setdefault('PYVISA_LIBRARY', '@py')
+pytest.importorskip('visa')
+
+from vna.config import Config
+from vna.driver import E5071X, N5232A, Segment, InstrumentError
+from vna.simserver import Server
+
+MODELS = {'E5071X': E5071X, 'N5232A': N5232A}
+
+SEGMENTS = [(2.5e9, 2e6, 201), (4.529e9, 1.5e6, 101)]
+
+
+@pytest.fixture
+def server():
+    server = Server(('127.0.0.1', 0))
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def connect(server, model='E5071X', use_markers=False, **config):
+    config = Config(dict(config, model=model, resource=server.resource))
+    vna = MODELS[model](config)
+    vna.setup(use_markers)
+    return vna
+
+
+def make_segments(rows=SEGMENTS):
+    return [Segment(str(i), f0, span, points)
+            for i, (f0, span, points) in enumerate(rows)]
+
+
+def expected_freq(rows=SEGMENTS):
+    return np.concatenate([np.linspace(f0 - span/2, f0 + span/2, points)
+                           for f0, span, points in rows])
+
+
+def table(server, vna, channel=1):
+    """(f0, span, points) of each segment on the server"""
+    # Writes are not answered, so wait for the server to get through them
+    vna.res.query("*OPC?")
+    return [(s.f0, s.span, s.points)
+            for s in server.vna.model.segments.get(channel, [])]
+
+
+@pytest.mark.parametrize('model', sorted(MODELS))
+@pytest.mark.parametrize('binary', [True, False], ids=['binary', 'ascii'])
+def test_trace_and_frequency_axis(server, model, binary):
+    vna = connect(server, model, binary_transfer=binary)
+    try:
+        vna.set_segments(make_segments())
+        vna.trigger(False)
+        freq = np.asarray(vna.get_freq_data())
+        data = vna.get_sweep_data()
+    finally:
+        vna.cleanup()
+    expected = expected_freq()
+    if binary:
+        np.testing.assert_array_equal(freq, expected)
+    else:
+        np.testing.assert_allclose(freq, expected, rtol=1e-12)
+    assert data.shape == (2, len(expected))
+    # Each window is centered on one of the simulated resonances
+    start = 0
+    for f0, span, points in SEGMENTS:
+        peak = freq[start + np.argmax(data[0][start:start+points])]
+        assert abs(peak - f0) < span/2
+        start += points
+
+
+def test_segment_data_table(server):
+    vna = connect(server, 'E5071X')
+    try:
+        assert vna.set_segments(make_segments())
+        assert table(server, vna) == SEGMENTS
+        # An unchanged table is not sent again
+        assert not vna.set_segments(make_segments())
+    finally:
+        vna.cleanup()
+
+
+@pytest.mark.parametrize('binary', [True, False], ids=['binary', 'ascii'])
+def test_segment_list_table(server, binary):
+    vna = connect(server, 'N5232A', binary_transfer=binary)
+    try:
+        vna.set_segments(make_segments())
+        assert table(server, vna) == SEGMENTS
+    finally:
+        vna.cleanup()
+    assert all(s.enabled for s in server.vna.model.segments[1])
+
+
+def test_moved_segments(server):
+    vna = connect(server, 'N5232A')
+    commands = []
+    execute = server.vna.execute
+    def record(command):
+        commands.append(command)
+        return execute(command)
+    server.vna.execute = record
+    try:
+        vna.set_segments(make_segments())
+        assert table(server, vna) == SEGMENTS
+        moved = [(2.5002e9, 1.8e6, 201), SEGMENTS[1]]
+        del commands[:]
+        vna.set_segments(make_segments(moved))
+        freq = np.asarray(vna.get_freq_data())
+        assert table(server, vna) == moved
+    finally:
+        vna.cleanup()
+    # Only the center and span of the moved segment are written
+    edits = [c for c in commands if 'SEGM' in c.upper()]
+    assert len(edits) == 2
+    assert all(':SENS1:SEGM1:FREQ:' in c for c in edits)
+    np.testing.assert_allclose(freq, expected_freq(moved), rtol=1e-12)
+
+
+def test_all_marker_data(server):
+    vna = connect(server, 'E5071X', use_markers=True)
+    try:
+        vna.set_segments(make_segments())
+        vna.trigger(True, force=True)
+        markers = vna.get_all_marker_data(len(SEGMENTS))
+        single = [vna.get_marker_data(i+1) for i in range(len(SEGMENTS))]
+    finally:
+        vna.cleanup()
+    assert len(markers) == len(SEGMENTS)
+    for (bw, f0, q, il), (center, span, points) in zip(markers, SEGMENTS):
+        assert abs(f0 - center) < span/2
+        assert 0.0 < bw < span
+        assert q == pytest.approx(f0/bw)
+    for values, expected in zip(single, markers):
+        assert len(values) == 4
+        assert values[1] == pytest.approx(expected[1], rel=1e-6)
+
+
+def test_malformed_marker_data(server):
+    vna = connect(server, 'E5071X', use_markers=True)
+    execute = server.vna.execute
+    def truncate(command):
+        response = execute(command)
+        if 'MARK2' in command:
+            # Cut off part way through the second marker's values
+            response = response[:len(response)//2]
+        return response
+    server.vna.execute = truncate
+    try:
+        vna.set_segments(make_segments())
+        with pytest.raises(InstrumentError):
+            vna.get_all_marker_data(len(SEGMENTS))
+    finally:
+        vna.cleanup()
+
+
+@pytest.mark.parametrize('completion', ['poll', 'srq'])
+def test_poll_completion(server, completion):
+    server.vna.point_time = 1e-4
+    vna = connect(server, 'E5071X', sweep_completion=completion)
+    try:
+        # Raw sockets cannot deliver service requests
+        assert vna.completion == 'poll'
+        vna.set_segments(make_segments())
+        sweep_time = sum(points for _, _, points in SEGMENTS)*1e-4
+        assert vna.get_sweep_time() == pytest.approx(sweep_time)
+        start = time.time()
+        vna.start_sweep()
+        vna.wait_sweep()
+        assert time.time() - start >= sweep_time
+        assert time.time() >= server.vna.sweep_end
+        data = vna.get_sweep_data()
+    finally:
+        vna.cleanup()
+    assert data.shape == (2, sum(points for _, _, points in SEGMENTS))
@@ -4,3 +4,5 @@ class Config(TObject):
     type_ = TString("visaScript")
     resource = TString()
     script = TString()
+    queue_size = TInt(10000)
+    queue_overflow = TString("drop_oldest")
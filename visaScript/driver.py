@@ -7,7 +7,7 @@ class HaltException(Exception):
 
 class Driver(Instrument):
     def __init__(self, config):
-        super().__init__()
+        super().__init__(int(config.queue_size), str(config.queue_overflow))
         self.config = config
         self.recording = False
         self.res = None
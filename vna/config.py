@@ -13,9 +13,25 @@ class Config(TObject):
     type_ = TString("vna")
     model = TString()
     resource = TString()
+    binary_transfer = TBool(True)
+    sweep_completion = TString("opc")
     track_frequency = TBool(True)
     track_span = TBool(True)
+    retrack_sweep = TBool(True)
     use_markers = TBool()
     bandwidth_factor = TFloat(4.0)
     segments = TDict(Segment)
     sample_interval = TFloat(0.0)
+    sample_overrun = TString("skip")
+    queue_size = TInt(10000)
+    queue_overflow = TString("drop_oldest")
+    fit_mode = TString("full")
+    fit_workers = TInt(0)
+    freq_check_interval = TInt(0)
+    pipeline_sweeps = TBool()
+    channels = TInt(1)
+    target_rate = TFloat(0.0, suffix="Hz")
+    sweep_shape = TString("linear")
+    track_mode = TString("reactive")
+    search_span = TFloat(0.0, suffix="Hz")
+    search_points = TInt(1001)
@@ -135,17 +135,12 @@ class DataWindow(
             self.instrument.set_segment_enabled(row, checked)
 
     def addSample(self, elapsed, timestamp, sample):
+        # Segments without a fit are NaN, which leaves a gap in the plots
         for freq, frequencyBuffer in zip(sample.f0, self.frequencyBuffers):
-            if freq is not None:
-                frequencyBuffer.append(freq)
-            else:
-                frequencyBuffer.append(np.nan)
+            frequencyBuffer.append(freq)
 
         for qfac, qFactorBuffer in zip(sample.q, self.qFactorBuffers):
-            if qfac is not None:
-                qFactorBuffer.append(qfac)
-            else:
-                qFactorBuffer.append(np.nan)
+            qFactorBuffer.append(qfac)
 
         self.timeBuffer.append(elapsed)
 
@@ -184,13 +179,13 @@ class DataWindow(
 
         if self.lastSample:
             for row, f in enumerate(self.lastSample.f0):
-                if f is not None:
+                if not np.isnan(f):
                     self.segmentTable.item(row, 1).setText(float_to_si(f, 6) + "Hz")
             for row, q in enumerate(self.lastSample.q):
-                if q is not None:
+                if not np.isnan(q):
                     self.segmentTable.item(row, 2).setText(float_to_si(q, 6))
             for row, il in enumerate(self.lastSample.il):
-                if il is not None:
+                if not np.isnan(il):
                     self.segmentTable.item(row, 3).setText(float_to_si(il, 6) + "dB")
 
             index = self.fitMode.currentIndex()
@@ -1,4 +1,6 @@
 from instrument import Instrument, runlater, InstrumentError
+from latency import NULL_TIMER
+from scheduler import DeadlineScheduler
 import math
 import random
 import numpy as np
@@ -6,51 +8,240 @@ from scipy.optimize import curve_fit
 from scipy.stats import linregress
 import time
 import copy
-from datetime import datetime, timezone, timedelta
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 import itertools
 
 
+# The IF bandwidths most instruments can set are these times a power of ten
+IFBW_STEPS = (1.0, 1.5, 2.0, 3.0, 4.0, 5.0, 7.0)
 
+class Model(object):
+    """
+    Base class for the VNA models
+
+    The frequency axis only changes with the segment table, so it is read
+    once after each call to set_segments and cached. A copy of the last
+    table uploaded to each channel is kept as well, so that unchanged tables
+    are not sent again.
+    """
+    ifbw_steps = IFBW_STEPS
+
+    def __init__(self):
+        self.freq_cache = {}
+        self.uploaded = {}
+        # Re-read the cached frequency axis every this many reads to check it
+        # is still correct, zero disables the check
+        self.freq_check_interval = 0
+        self.freq_reads = 0
+        # One of SWEEP_SHAPES
+        self.sweep_shape = 'linear'
+
+    def set_segments(self, segments, channel=1):
+        """Upload the segment table, returns False if it was unchanged"""
+        table = [row for s in segments if s.enabled
+                 for row in sweep_rows(s, self.sweep_shape)]
+        last = self.uploaded.get(channel)
+        if table == last:
+            return False
+        self.freq_cache.pop(channel, None)
+        # Rows whose window moved, everything else must match for the
+        # instrument's table to be edited in place
+        moved = None
+        if last is not None and len(last) == len(table):
+            if all(a[2:] == b[2:] for a, b in zip(last, table)):
+                moved = [i for i, (a, b) in enumerate(zip(last, table)) if a != b]
+        if moved is None or not self.write_moved_segments(table, moved, channel):
+            self.write_segments(table, channel)
+        self.uploaded[channel] = table
+        return True
+
+    def get_freq_data(self, channel=1):
+        freq = self.freq_cache.get(channel)
+        if freq is None:
+            freq = self.freq_cache[channel] = self.query_freq_data(channel)
+        elif self.freq_check_interval > 0:
+            self.freq_reads += 1
+            if self.freq_reads >= self.freq_check_interval:
+                self.freq_reads = 0
+                actual = self.query_freq_data(channel)
+                if not np.array_equal(actual, freq):
+                    print("Cached frequency axis was out of date")
+                    freq = self.freq_cache[channel] = actual
+        return freq
+
+    def write_segments(self, rows, channel=1):
+        """
+        Override this to send the segment table to the instrument
+
+        Each row is a tuple of (f0, span, points, ifbw, power).
+        """
+        raise NotImplementedError()
+
+    def write_moved_segments(self, rows, moved, channel=1):
+        """
+        Override this to update only the center and span of the rows at the
+        indices in moved, returning True if it did so
+
+        The table on the instrument has the same number of rows. By default
+        the whole table is rewritten.
+        """
+        return False
+
+    def get_all_marker_data(self, count, channel=1):
+        """
+        Return (bw, f0, q, il) for markers 1 to count
+
+        Override this if the instrument can return them all in one query.
+        """
+        return [self.get_marker_data(i+1, channel) for i in range(count)]
+
+    def start_sweep(self):
+        """Override this to trigger a single sweep without waiting for it"""
+        raise NotImplementedError()
+
+    def wait_sweep(self):
+        """Override this to wait for the sweep started by start_sweep"""
+        pass
+
+    def query_freq_data(self, channel=1):
+        """Override this to read the frequency axis from the instrument"""
+        raise NotImplementedError()
+
+
+SWEEP_COMPLETIONS = ('opc', 'srq', 'poll')
+
+class ScpiModel(Model):
+    """
+    Base class for models controlled by SCPI commands over VISA
+
+    Subclasses set trigger_command and self.res. How the end of a sweep is
+    detected depends on self.completion:
+
+    'opc' blocks on *OPC? after triggering.
+    'srq' sends *OPC with the trigger so the instrument raises a service
+    request when the sweep completes, which wait_sweep waits for. Resources
+    that cannot deliver service requests, such as raw sockets, fall back to
+    'poll'.
+    'poll' also sends *OPC, then wait_sweep sleeps for the sweep time the
+    instrument reports before polling *ESR? for the operation complete bit.
+    """
+    trigger_command = None
+    poll_interval = 0.001
+
+    def __init__(self):
+        super().__init__()
+        self.channels = 1
+        self.completion = 'opc'
+        self.sweep_time = None
+        self.sweep_start = 0.0
+
+    def setup_completion(self):
+        if self.completion == 'srq' and not self.res.enable_srq():
+            self.completion = 'poll'
+        if self.completion == 'srq':
+            # Operation complete sets the event summary bit, which requests
+            # service
+            self.res.write("*ESE {}", 1)
+            self.res.write("*SRE {}", 32)
+        self.res.write("*CLS")
+
+    def set_segments(self, segments, channel=1):
+        if not super().set_segments(segments, channel):
+            return False
+        self.sweep_time = None
+        return True
+
+    def get_sweep_time(self):
+        if self.sweep_time is None:
+            # Channels are swept one after another
+            self.sweep_time = sum(float(self.res.query(":SENS{}:SWE:TIME?", ch))
+                                  for ch in range(1, self.channels+1))
+        return self.sweep_time
+
+    def start_sweep(self):
+        if self.completion == 'opc':
+            self.res.write(self.trigger_command)
+        else:
+            if self.completion == 'poll':
+                self.get_sweep_time()
+            self.sweep_start = time.time()
+            self.res.write(self.trigger_command + ";*OPC")
+
+    def wait_sweep(self):
+        if self.completion == 'opc':
+            self.res.query("*OPC?")
+        elif self.completion == 'srq':
+            self.res.wait_for_srq()
+            # Reading the event status register clears the request
+            self.res.query("*ESR?")
+        else:
+            remaining = self.sweep_start + self.get_sweep_time() - time.time()
+            if remaining > 0.0:
+                time.sleep(remaining)
+            while not int(self.res.query("*ESR?")) & 1:
+                time.sleep(self.poll_interval)
+
+
+class E5071X(ScpiModel):
+    trigger_command = ":TRIG:SING"
 
-class E5071X:
     def __init__(self, config):
+        super().__init__()
         global VisaIOError, onoff
         import visa
         from pyvisa.errors import VisaIOError
         import scpi
         from scpi import onoff
         rm = visa.ResourceManager()
-        self.res = scpi.Wrapper(rm.open_resource(config.resource))
+        self.res = scpi.Wrapper(scpi.open_resource(rm, config.resource))
+        self.binary = bool(config.binary_transfer)
+        self.completion = str(config.sweep_completion)
 
     def supports_markers(self):
         return True
 
-    def setup(self, use_markers):
+    def setup(self, use_markers, channels=1):
         self.res.reset()
-        self.res.write(":CALC1:PAR1:DEF {}", "S21")
-        self.res.write(":INIT1:CONT {}", onoff(True))
+        self.setup_completion()
+        self.channels = channels
+        if self.binary:
+            # 64 bit big endian floats, also used for the segment table
+            self.res.write(":FORM:DATA {}", "REAL")
+            self.res.write(":FORM:BORD {}", "NORM")
+        else:
+            self.res.write(":FORM:DATA {}", "ASC")
+        if channels > 1:
+            # Only displayed channels are swept, one trigger sweeps them all
+            self.res.write(":DISP:SPL {}", split_layout(channels))
+            self.res.write(":TRIG:SCOP {}", "ALL")
+        for ch in range(1, channels+1):
+            self.res.write(":CALC{}:PAR1:DEF {}", ch, "S21")
+            self.res.write(":INIT{}:CONT {}", ch, onoff(True))
 
         if not use_markers:
             self.res.write(":TRIG:SOUR BUS")
-        self.res.write(":SENS1:SWE:TYPE {}", "SEGM")
-        self.res.write(":SENS1:SWE:DELAY {}", 0.001)
-        self.res.write(":SENS1:SWE:GEN {}", "STEP")
+        for ch in range(1, channels+1):
+            self.res.write(":SENS{}:SWE:TYPE {}", ch, "SEGM")
+            self.res.write(":SENS{}:SWE:DELAY {}", ch, 0.001)
+            self.res.write(":SENS{}:SWE:GEN {}", ch, "STEP")
         if use_markers:
             self.res.write(":CALC1:MARK:BWID {}", onoff(True))
             self.res.write(":CALC1:MARK:FUNC:MULT:TYPE {}", "PEAK")
             self.res.write(":CALC1:MARK:FUNC:EXEC")
             self.res.write(":CALC1:MARK:FUNC:MULT:TRAC {}", onoff(True))
 
-    def set_segments(self, segments):
-        enacount = 0
+    def write_segments(self, rows, channel=1):
         # [<buf>,<stim>,<ifbw>,<pow>,<del>,<time>,<segm>]
-        data = [5, 1, 1, 1, 0, 0, None]
-        for s in segments:
-            if s.enabled:
-                enacount += 1
-                data += [s.f0, s.span, s.points, s.ifbw, s.power]
-        data[6] = enacount
-        self.res.write_ascii_values(":SENS1:SEGM:DATA", data)
+        data = [5, 1, 1, 1, 0, 0, len(rows)]
+        for f0, span, points, ifbw, power in rows:
+            data += [f0, span, points, ifbw, power]
+        if self.binary:
+            self.res.write_binary_values(":SENS{}:SEGM:DATA", data, channel)
+        else:
+            self.res.write_ascii_values(":SENS{}:SEGM:DATA", data, channel)
 
     def autoscale(self):
         self.res.write(":DISP:WIND1:TRAC1:Y:AUTO")
@@ -61,67 +252,114 @@ class E5071X:
             self.res.write(":TRIG:SOUR BUS")
 
         if (not use_markers) or force:
-            self.res.write(":TRIG:SING")
-            self.res.query("*OPC?")
+            self.start_sweep()
+            self.wait_sweep()
 
         if use_markers and force:
             # Reset back to default
             self.res.write(":TRIG:SOUR INT")
 
+
     def get_marker_data(self, marker=1, channel=1):
         try:
             return self.res.query_ascii_values(":CALC{}:MARK{}:BWID:DATA?", channel, marker)
         except VisaIOError:
             raise InstrumentError()
 
-    def get_sweep_data(self):
-        data = self.res.query_ascii_values(":CALC1:DATA:SDAT?")
-        return np.array(data).reshape((-1, 2)).T
+    def get_all_marker_data(self, count, channel=1):
+        # Queries joined with semicolons are answered in one response, with
+        # the individual results separated by semicolons
+        query = ";".join(":CALC{}:MARK{}:BWID:DATA?".format(channel, i+1)
+                         for i in range(count))
+        try:
+            response = self.res.query(query)
+        except VisaIOError:
+            raise InstrumentError()
+        # A truncated or garbled response must not end the acquire loop
+        try:
+            markers = [[float(x) for x in result.split(",")]
+                       for result in response.strip().split(";")]
+        except ValueError:
+            raise InstrumentError("Malformed marker data: {!r}".format(response))
+        if len(markers) != count or any(len(values) != 4 for values in markers):
+            raise InstrumentError("Malformed marker data: {!r}".format(response))
+        return markers
+
+    def get_sweep_data(self, channel=1):
+        if self.binary:
+            data = self.res.query_binary_values(":CALC{}:DATA:SDAT?", channel,
+                                                container=np.ndarray)
+        else:
+            data = np.array(self.res.query_ascii_values(":CALC{}:DATA:SDAT?", channel))
+        return data.reshape((-1, 2)).T
 
-    def get_freq_data(self, channel=1):
+    def query_freq_data(self, channel=1):
+        if self.binary:
+            return self.res.query_binary_values(":SENS{}:FREQ:DATA?", channel,
+                                                container=np.ndarray)
         return self.res.query_ascii_values(":SENS{}:FREQ:DATA?", channel)
 
     def cleanup(self):
         self.res.close()
 
 
-class N5232A:
+class N5232A(ScpiModel):
+    trigger_command = ":INIT:IMM"
+
     def __init__(self, config):
+        super().__init__()
+        global VisaIOError, onoff
         import visa
         from pyvisa.errors import VisaIOError
         import scpi
         from scpi import onoff
         rm = visa.ResourceManager()
-        self.res = scpi.Wrapper(rm.open_resource(config.resource))
+        self.res = scpi.Wrapper(scpi.open_resource(rm, config.resource))
+        self.binary = bool(config.binary_transfer)
+        self.completion = str(config.sweep_completion)
 
     def supports_markers(self):
         return False
 
-    def setup(self, use_markers):
+    def setup(self, use_markers, channels=1):
         self.res.reset()
+        self.setup_completion()
+        self.channels = channels
         if use_markers:
             raise ValueError("N5232A currently does not support markers")
-        self.res.write(":CALC1:PAR1:DEF {}", "S21")
-        self.res.write(":INIT1:CONT {}", onoff(True))
+        if self.binary:
+            self.res.write(":FORM:DATA {}", "REAL,64")
+            self.res.write(":FORM:BORD {}", "NORM")
+        else:
+            self.res.write(":FORM:DATA {}", "ASC,0")
+        for ch in range(1, channels+1):
+            self.res.write(":CALC{}:PAR1:DEF {}", ch, "S21")
+            self.res.write(":INIT{}:CONT {}", ch, onoff(True))
         if not use_markers:
             self.res.write(":TRIG:SOUR MAN")
-        self.res.write(":SENS1:SWE:TYPE {}", "SEGM")
-        self.res.write(":SENS1:SWE:DELAY {}", 0.001)
-        self.res.write(":SENS1:SWE:GEN {}", "STEP")
-
-    def set_segments(self, segments, channel=1):
-        enacount = 0
-        data = ["SSTOP", None]
-        for s in segments:
-            if s.enabled:
-                enacount += 1
-                data += [1, s.points, s.f0, s.span, s.ifbw, 0, s.power]
-        data[1] = enacount
+        if channels > 1:
+            self.res.write(":TRIG:SCOP {}", "ALL")
+        for ch in range(1, channels+1):
+            self.res.write(":SENS{}:SWE:TYPE {}", ch, "SEGM")
+            self.res.write(":SENS{}:SWE:DELAY {}", ch, 0.001)
+            self.res.write(":SENS{}:SWE:GEN {}", ch, "STEP")
+
+    def write_segments(self, rows, channel=1):
+        data = ["CSPAN", len(rows)]
+        for f0, span, points, ifbw, power in rows:
+            data += [1, points, f0, span, ifbw, 0, power]
 
         self.res.write(":SENS{}:SEGM:BWID:CONT {}", channel, onoff(True))
         self.res.write(":SENS{}:SEGM:POW:CONT {}", channel, onoff(True))
         self.res.write_ascii_values(":SENS{}:SEGM:LIST", data, channel)
 
+    def write_moved_segments(self, rows, moved, channel=1):
+        for i in moved:
+            f0, span = rows[i][:2]
+            self.res.write(":SENS{}:SEGM{}:FREQ:CENT {}", channel, i+1, f0)
+            self.res.write(":SENS{}:SEGM{}:FREQ:SPAN {}", channel, i+1, span)
+        return True
+
     def autoscale(self):
         self.res.write(":DISP:WIND1:TRAC1:Y:AUTO")
 
@@ -131,29 +369,40 @@ class N5232A:
             self.res.write(":TRIG:SOUR MAN")
 
         if (not use_markers) or force:
-            self.res.write(":INIT:IMM")
-            self.res.query("*OPC?")
+            self.start_sweep()
+            self.wait_sweep()
 
         if use_markers and force:
             # Reset back to default
             self.res.write(":TRIG:SOUR INT")
 
+
     def get_marker_data(self, marker=1, channel=1):
         raise NotImplementedError()
 
-    def get_sweep_data(self):
-        data = self.res.query_ascii_values(":CALC1:DATA? SDAT")
-        return np.array(data).reshape((-1, 2)).T
+    def get_sweep_data(self, channel=1):
+        if self.binary:
+            data = self.res.query_binary_values(":CALC{}:DATA? SDAT", channel,
+                                                container=np.ndarray)
+        else:
+            data = np.array(self.res.query_ascii_values(":CALC{}:DATA? SDAT", channel))
+        return data.reshape((-1, 2)).T
 
-    def get_freq_data(self):
-        return self.res.query_ascii_values(":CALC1:X?")
+    def query_freq_data(self, channel=1):
+        if self.binary:
+            return self.res.query_binary_values(":CALC{}:X?", channel,
+                                                container=np.ndarray)
+        return self.res.query_ascii_values(":CALC{}:X?", channel)
 
     def cleanup(self):
         self.res.close()
 
 
-class S2VNA:
+class S2VNA(Model):
+    ifbw_steps = (1.0, 1.5, 2.0, 3.0, 5.0, 7.0)
+
     def __init__(self, config):
+        super().__init__()
         import pythoncom, win32com.client
         pythoncom.CoInitialize()
         self.app = win32com.client.Dispatch('S2VNA.application')
@@ -169,50 +418,55 @@ class S2VNA:
     def supports_markers(self):
         return False
 
-    def setup(self, use_markers):
+    def setup(self, use_markers, channels=1):
         self.app.scpi.system.preset()
         self.app.scpi.trigger.sequence.source = "bus"
-        self.app.scpi.GetCALCulate(1).GetPARameter(1).define = 'S21'
-        self.app.scpi.GetINITiate(1).continuous = True
-        self.app.scpi.GetSENSe(1).sweep.type = 'segment'
-        self.app.scpi.GetSENSe(1).sweep.point.time = 0.001
-        self.app.scpi.display.GetWINDow(1).X.spacing = 'obase'
+        if channels > 1:
+            self.app.scpi.display.split = split_layout(channels)
+            self.app.scpi.trigger.sequence.scope = "all"
+        for ch in range(1, channels+1):
+            self.app.scpi.GetCALCulate(ch).GetPARameter(1).define = 'S21'
+            self.app.scpi.GetINITiate(ch).continuous = True
+            self.app.scpi.GetSENSe(ch).sweep.type = 'segment'
+            self.app.scpi.GetSENSe(ch).sweep.point.time = 0.001
+            self.app.scpi.display.GetWINDow(ch).X.spacing = 'obase'
         # self.res.write(":SENS1:SWE:GEN {}", "STEP") # TODO find me if I exist
 
-    def set_segments(self, segments, channel=1):
-        enacount = 0
+    def write_segments(self, rows, channel=1):
         # [<buf>,<stim>,<ifbw>,<pow>,<del>,<time>,<segm>]
-        data = [5, 1, 1, 1, 0, 0, None]
-        for s in segments:
-            if s.enabled:
-                enacount += 1
-                data += [s.f0, s.span, s.points, s.ifbw, s.power]
-        data[6] = enacount
-        self.app.scpi.GetSENSe(1).segment.data = data
+        data = [5, 1, 1, 1, 0, 0, len(rows)]
+        for f0, span, points, ifbw, power in rows:
+            data += [f0, span, points, ifbw, power]
+        self.app.scpi.GetSENSe(channel).segment.data = data
 
     def autoscale(self):
         pass
 
     def trigger(self, use_markers, force=False):
+        self.start_sweep()
+
+    def start_sweep(self):
         self.app.scpi.trigger.sequence.SINGle()
 
     def get_marker_data(self, marker=1, channel=1):
         raise NotImplementedError()
 
-    def get_sweep_data(self):
-        data = self.app.scpi.GetCALCulate(1).selected.data.sdata
+    def get_sweep_data(self, channel=1):
+        data = self.app.scpi.GetCALCulate(channel).selected.data.sdata
         return np.array(data).reshape((-1, 2)).T
 
-    def get_freq_data(self):
-        return self.app.scpi.GetSENSe(1).frequency.data
+    def query_freq_data(self, channel=1):
+        return self.app.scpi.GetSENSe(channel).frequency.data
 
     def cleanup(self):
         del self.app
 
 
-class Simulated:
+class Simulated(Model):
     def __init__(self, config):
-        self.segments = []
+        super().__init__()
+        # Segment tables by channel
+        self.segments = {}
         def make_sin(center, deviation, period):
             def fn(t):
                 return math.sin(t*2.0*math.pi/period)*deviation + center
@@ -223,28 +477,38 @@ class Simulated:
     def supports_markers(self):
         return False
 
-    def setup(self, use_markers):
+    def setup(self, use_markers, channels=1):
         self.start_t = time.time()
 
-    def set_segments(self, segments, channel=1):
-        self.segments = [segment.copy() for segment in segments]
+    def write_segments(self, rows, channel=1):
+        self.segments[channel] = [Segment(str(i), *row)
+                                  for i, row in enumerate(rows)]
 
     def autoscale(self):
         pass
 
     def trigger(self, use_markers, force=False):
-        time.sleep(0.001)
+        self.start_sweep()
+        self.wait_sweep()
+
+    def start_sweep(self):
+        self.sweep_end = time.time() + 0.001
+
+    def wait_sweep(self):
+        remaining = self.sweep_end - time.time()
+        if remaining > 0.0:
+            time.sleep(remaining)
 
     def get_marker_data(self, marker=1, channel=1):
         raise NotImplementedError()
 
-    def get_sweep_data(self):
-        frequencies = self.get_freq_data()
+    def get_sweep_data(self, channel=1):
+        frequencies = self.get_freq_data(channel)
         amplitudes = np.zeros((2, len(frequencies)))
         delta_t = time.time() - self.start_t
 
         idx = 0
-        for segment in self.segments:
+        for segment in self.segments.get(channel, []):
             if segment.enabled:
                 freqs = frequencies[idx:idx+segment.points]
                 amplitudes[1][idx:idx+segment.points] = 0.0
@@ -254,15 +518,16 @@ class Simulated:
                 idx += segment.points
         return amplitudes
 
-    def get_freq_data(self):
+    def query_freq_data(self, channel=1):
+        segments = self.segments.get(channel, [])
         enabled_pts = 0
-        for segment in self.segments:
+        for segment in segments:
             if segment.enabled:
                 enabled_pts += segment.points
 
         frequencies = np.zeros(enabled_pts)
         idx = 0
-        for segment in self.segments:
+        for segment in segments:
             if segment.enabled:
                 start = segment.f0-(segment.span/2.0)
                 stop = segment.f0+(segment.span/2.0)
@@ -273,12 +538,53 @@ class Simulated:
     def cleanup(self):
         pass
 
+def split_layout(channels):
+    """The smallest display split with a window for each channel"""
+    layouts = [(1, "D1"), (2, "D12"), (3, "D123"), (4, "D1234"),
+               (6, "D123_456"), (8, "D1234_5678"), (9, "D123_456_789"),
+               (12, "D1234__9ABC"), (16, "D1234__CDEF")]
+    for windows, layout in layouts:
+        if windows >= channels:
+            return layout
+    raise ValueError("Too many channels: {}".format(channels))
+
 class Driver(Instrument):
     def __init__(self, config):
-        super().__init__()
+        super().__init__(int(config.queue_size), str(config.queue_overflow))
         self.forced_retrack = False
         self.config = config
         self.cfg = VNAState(config)
+        if self.cfg.fit_mode not in FIT_MODES:
+            raise ValueError("Unknown fit mode '{}'".format(self.cfg.fit_mode))
+        if self.cfg.sweep_shape not in SWEEP_SHAPES:
+            raise ValueError("Unknown sweep shape '{}'".format(self.cfg.sweep_shape))
+        if self.cfg.track_mode not in TRACK_MODES:
+            raise ValueError("Unknown track mode '{}'".format(self.cfg.track_mode))
+        if config.sweep_completion not in SWEEP_COMPLETIONS:
+            raise ValueError("Unknown sweep completion '{}'".format(config.sweep_completion))
+        self.scheduler = DeadlineScheduler(self.cfg.sample_interval,
+                                           self.cfg.sample_overrun)
+        self.pool = None
+        self.pending = collections.deque()
+        # Incremented whenever a new segment table is sent to the instrument
+        self.generation = 0
+        self.pipelined = False
+        # When the pipelined sweep in progress was started
+        self.sweep_started = None
+        self.segments_dirty = False
+        # Whether the table waiting to be sent was changed by a retrack, so
+        # that sending it is counted in the retrack time
+        self.retrack_upload = False
+        # Points of the enabled segments in the table on the instrument
+        self.table = []
+        self.budget = None
+        # Generation of the table of the last sample
+        self.sampled_generation = 0
+        self.retrack_stats = {'retracks': 0, 'forced_sweeps': 0, 'searches': 0,
+                              'time': 0.0}
+        self.last_track = None
+        # Estimated time between samples, used to look ahead when tracking
+        self.sample_period = 0.0
 
     def setup(self):
         if self.config.model == 'N5232A':
@@ -292,27 +598,63 @@ class Driver(Instrument):
 
         if not self.driver.supports_markers():
             self.cfg.use_markers = False
-
-        self.driver.setup(self.cfg.use_markers)
-        self.driver.set_segments(self.cfg.segments)
+        # Markers are only read from the first channel, and every channel
+        # needs at least one segment
+        if self.cfg.use_markers:
+            self.cfg.channels = 1
+        self.cfg.channels = max(1, min(self.cfg.channels, len(self.cfg.segments)))
+
+        self.driver.freq_check_interval = self.cfg.freq_check_interval
+        # Markers are placed per instrument segment
+        if not self.cfg.use_markers:
+            self.driver.sweep_shape = self.cfg.sweep_shape
+        self.driver.setup(self.cfg.use_markers, self.cfg.channels)
+        if self.budget_enabled():
+            self.budget = SweepBudget(self.cfg.target_rate, self.driver.ifbw_steps)
+            # Log the IF bandwidths the instrument will actually use
+            self.budget.apply(self.cfg.segments)
+        self.upload_segments()
+        self.flush_segments()
+        self.sampled_generation = self.generation
         time.sleep(1.0)
         self.driver.autoscale()
         self.last_sample = None
 
-        self.next_call = datetime.now(timezone.utc)
+        if self.cfg.fit_workers > 0 and not self.cfg.use_markers:
+            # Forking from the acquire thread with the GUI running is unsafe,
+            # and spawning is what instrument processes do too
+            self.pool = ProcessPoolExecutor(
+                self.cfg.fit_workers, mp_context=multiprocessing.get_context('spawn'))
+
+        # Markers are read from a continuously sweeping instrument, so there
+        # is nothing to overlap
+        self.pipelined = self.cfg.pipeline_sweeps and not self.cfg.use_markers
+        if self.pipelined:
+            self.start_sweep()
 
     def sample(self):
-        self.driver.trigger(self.cfg.use_markers)
-        sampletime = datetime.now(timezone.utc)
+        started = time.perf_counter()
+        timer = self.latency.timer()
+        if self.pipelined:
+            # The sweep was started at the end of the previous call, which may
+            # have been a whole sample interval ago
+            self.driver.wait_sweep()
+            sampletime = self.sweep_started
+        else:
+            self.flush_segments()
+            self.driver.trigger(self.cfg.use_markers)
+            sampletime = datetime.now(timezone.utc)
+        timer.lap('trigger')
 
-        data = Sample()
         if self.cfg.use_markers:
+            data = Sample(len(self.cfg.segments))
             try:
-                for i in range(len(self.cfg.segments)):
-                    bw, f0, q, il = self.driver.get_marker_data(i+1)
-                    data.add_segment(bw, f0, q, il)
+                markers = self.driver.get_all_marker_data(len(self.cfg.segments))
+                for i, (bw, f0, q, il) in enumerate(markers):
+                    data.set_segment(i, bw, f0, q, il)
             except InstrumentError:
                 return None
+            timer.lap('markers')
 
             # Discard duplicate samples
             if self.last_sample:
@@ -320,74 +662,372 @@ class Driver(Instrument):
                     return None
             self.last_sample = data
         else:
-            cplx = self.driver.get_sweep_data()
+            cplx, freq = self.read_sweep(timer=timer)
             ampl = np.sqrt(cplx[0]**2 + cplx[1]**2)
-            freq = self.driver.get_freq_data()
+            # Warm start each fit from the previous sweep if there was one
+            layout = [(entry[0], seg.fit) if entry is not None else None
+                      for seg, entry in zip(self.cfg.segments, self.table)]
+            settings = [entry or (None, None) for entry in self.table]
+            # The table this sweep was taken on, before any flush below
+            generation = self.generation
+
+            if self.pipelined:
+                # Start the next sweep before fitting this one. Any new segment
+                # table must be sent first, as the instrument is idle only here
+                self.flush_segments()
+                self.start_sweep()
+                timer.lap('trigger')
+
+            if self.pool is not None:
+                # Fit in the worker pool, samples are queued by collect_fits
+                future = self.pool.submit(fit_sweep, freq, ampl, layout,
+                                          self.cfg.fit_mode)
+                self.pending.append((sampletime, freq, ampl, layout, settings,
+                                     generation, future))
+                self.collect_fits()
+                timer.lap('collect_fits')
+                self.adjust_budget(started)
+                return None
 
-            start = 0
-            lost_track = False
-            for seg in self.cfg.segments:
-                if seg.enabled:
-                    f = freq[start:seg.points+start]
-                    a = ampl[start:seg.points+start]
-                    start += seg.points
-                    try:
-                        bw, f0, q, il, skew = lorentz_fit(f,a)
-                        data.add_segment(bw, f0, q, il, skew, freq=f, ampl=a)
-                    except (RuntimeError, ValueError):
-                        lost_track = True
-                        if self.cfg.track_freq and self.cfg.track_enabled:
-                            slope, intercept, rvalue, pvalue, stderr = linregress(f, a)
-                            if(slope > 0):
-                                seg.f0 += seg.span
-                            else:
-                                seg.f0 -= seg.span
-                else: #segment not enabled
-                    data.add_segment(None, None, None, None)
-
-            if lost_track:
-                if self.cfg.track_freq and self.cfg.track_enabled:
-                    self.driver.set_segments(self.cfg.segments)
+            fits = fit_sweep(freq, ampl, layout, self.cfg.fit_mode)
+            timer.lap('fit')
+            data = self.process_fits(freq, ampl, layout, fits, generation)
+            if data is None:
+                # Track was lost, and the segments nudged or searched for
+                timer.lap('reacquire')
+                self.adjust_budget(started)
                 return None
+            data.settings = settings
+
+        self.track(data, sampletime)
+        timer.lap('retrack')
+        self.adjust_budget(started)
+        return sampletime, data
 
+    def start_sweep(self):
+        """Start a pipelined sweep, noting the time to stamp its sample with"""
+        self.driver.start_sweep()
+        self.sweep_started = datetime.now(timezone.utc)
+
+    def adjust_budget(self, started):
+        """Rescale the sweeps for the time the last sample kept us busy"""
+        if self.budget is not None:
+            if self.budget.update(time.perf_counter() - started):
+                self.budget.apply(self.cfg.segments)
+                self.upload_segments()
+
+    def channel_segments(self, segments=None):
+        """Split the segments into contiguous groups, one per channel"""
+        if segments is None:
+            segments = self.cfg.segments
+        n = self.cfg.channels
+        return [segments[i*len(segments)//n:(i+1)*len(segments)//n]
+                for i in range(n)]
+
+    def read_sweep(self, segments=None, timer=NULL_TIMER):
+        """Read the trace and frequency axis of all channels in segment order"""
+        if self.cfg.channels == 1:
+            cplx = self.driver.get_sweep_data()
+            timer.lap('sweep_data')
+            freq = self.driver.get_freq_data()
+            timer.lap('freq_data')
+            return cplx, freq
+        cplx = []
+        freq = []
+        for channel, segments in enumerate(self.channel_segments(segments), 1):
+            if any(seg.enabled for seg in segments):
+                cplx.append(self.driver.get_sweep_data(channel))
+                timer.lap('sweep_data')
+                freq.append(self.driver.get_freq_data(channel))
+                timer.lap('freq_data')
+        return np.hstack(cplx), np.concatenate(freq)
+
+    def process_fits(self, freq, ampl, layout, fits, generation):
+        """
+        Build a Sample from the fits of one sweep
+
+        Returns None if track was lost on any segment, after nudging lost
+        segments towards their resonance or searching for it when search_span
+        is set. Segments are only nudged if the segment table has not changed
+        since the sweep was taken, and no change to it is waiting to be sent,
+        so that several fits on one window nudge it only once. Focused sweeps
+        are reshaped when the fitted bandwidth has moved by more than
+        FOCUS_BW_TOLERANCE.
+        """
+        data = Sample(len(self.cfg.segments))
+        bounds = []
+        start = 0
+        lost_track = False
+        lost = []
+        reshape = False
+        nudge = (self.cfg.track_freq and self.cfg.track_enabled
+                 and generation == self.generation and not self.segments_dirty)
+        for i, (seg, entry, fit) in enumerate(zip(self.cfg.segments, layout, fits)):
+            if entry is not None:
+                points = entry[0]
+                f = freq[start:points+start]
+                a = ampl[start:points+start]
+                bounds.append((start, start+points))
+                start += points
+                if fit is not None:
+                    bw, f0, q, il, skew = fit
+                    data.set_segment(i, bw, f0, q, il, skew)
+                    seg.fit = (f0, bw, 10.0**(il/20.0), skew)
+                    if (self.cfg.sweep_shape == 'focused' and bw > 0.0 and
+                            (seg.bw is None or
+                             abs(bw - seg.bw) > FOCUS_BW_TOLERANCE*seg.bw)):
+                        seg.bw = float(bw)
+                        reshape = True
+                    if self.budget is not None:
+                        self.budget.observe_fit(f, a, *seg.fit)
+                else:
+                    if self.budget is not None:
+                        self.budget.trouble = True
+                    lost_track = True
+                    seg.fit = None
+                    if nudge and self.cfg.search_span > 0.0:
+                        lost.append(seg)
+                    elif nudge:
+                        slope, intercept, rvalue, pvalue, stderr = linregress(f, a)
+                        if(slope > 0):
+                            seg.f0 += seg.span
+                        else:
+                            seg.f0 -= seg.span
+            else: #segment not enabled
+                bounds.append(None)
+
+        if lost_track:
+            if lost:
+                self.reacquire(lost)
+            elif nudge:
+                self.upload_segments()
+            return None
+        if reshape:
+            self.upload_segments()
+        data.set_traces(freq, ampl, bounds)
+        data.retracked = generation != self.sampled_generation
+        self.sampled_generation = generation
+        return data
+
+    def reacquire(self, lost):
+        """
+        Find the resonances of lost segments with one wide sweep
+
+        The lost segments are swept over search_span while the others keep
+        their windows, then the narrow windows are restored around whatever
+        was found.
+        """
+        started = time.perf_counter()
+        if self.pipelined:
+            # Let the sweep in progress finish before changing the table
+            self.driver.wait_sweep()
+        search = []
+        for seg in self.cfg.segments:
+            seg_search = seg.copy()
+            if seg in lost:
+                seg_search.span = self.cfg.search_span
+                seg_search.points = self.cfg.search_points
+                seg_search.bw = None
+            search.append(seg_search)
+        for channel, segments in enumerate(self.channel_segments(search), 1):
+            self.driver.set_segments(segments, channel)
+        self.driver.trigger(self.cfg.use_markers, force=True)
+        cplx, freq = self.read_sweep(search)
+        ampl = np.sqrt(cplx[0]**2 + cplx[1]**2)
+
+        start = 0
+        for seg, seg_search in zip(self.cfg.segments, search):
+            if not seg_search.enabled:
+                continue
+            points = seg_search.points
+            if seg in lost:
+                found = find_resonance(freq[start:start+points],
+                                       ampl[start:start+points])
+                if found is not None:
+                    f0, bw, pmax = found
+                    seg.f0 = float(f0)
+                    seg.fit = (float(f0), float(bw), float(pmax), 0.0)
+                    seg.drift = None
+            start += points
+
+        # Any retrack waiting to be sent goes with the search, and is timed
+        # with it
+        self.retrack_upload = False
+        self.segments_dirty = True
+        self.flush_segments()
+        if self.pipelined:
+            self.start_sweep()
+        self.retrack_stats['searches'] += 1
+        self.retrack_stats['time'] += time.perf_counter() - started
+
+    def collect_fits(self, wait=False):
+        """
+        Queue samples from the worker pool in the order they were swept
+
+        Blocks on the oldest fit while too many are in flight, or on all of
+        them if wait is set.
+        """
+        while self.pending:
+            future = self.pending[0][-1]
+            backlog = len(self.pending) > 2*self.cfg.fit_workers
+            if not (wait or backlog or future.done()):
+                break
+            sampletime, freq, ampl, layout, settings, generation, future = self.pending.popleft()
+            data = self.process_fits(freq, ampl, layout, future.result(), generation)
+            if data is not None:
+                data.settings = settings
+                # Tracking always acts on the latest completed fit
+                self.track(data, sampletime)
+                self.queue.put((sampletime, data))
+
+    def track(self, data, sampletime):
+        """Move the segment windows to follow the resonances in data"""
         tracking_enabled = self.cfg.track_freq or self.cfg.track_span
         if tracking_enabled and (self.cfg.track_enabled or self.forced_retrack):
+            t = sampletime.timestamp()
+            if self.last_track is not None:
+                period = t - self.last_track
+                if self.sample_period > 0.0:
+                    period = 0.8*self.sample_period + 0.2*period
+                self.sample_period = period
+            self.last_track = t
             retracked = False
+            # Windows the resonance has already left need a sweep on the new
+            # window before the next sample
+            late = False
+            factor = self.cfg.get_bw_factor()
             for seg, f0, bw in zip(self.cfg.segments, data.f0, data.bw):
-                if not seg.enabled:
+                if not seg.enabled or math.isnan(f0):
                     continue
                 trackf, tracks = track_window(seg.f0, seg.span, f0, bw,
-                                              bw_factor=self.cfg.get_bw_factor())
-                if (trackf and self.cfg.track_freq) or (tracks and self.cfg.track_span) or self.forced_retrack:
+                                              bw_factor=factor)
+                outside = ((trackf and self.cfg.track_freq)
+                           or (tracks and self.cfg.track_span) or self.forced_retrack)
+                leaving = False
+                if self.cfg.track_mode == 'predictive':
+                    f0, bw, leaving = self.predict_window(seg, t, f0, bw, trackf)
+                if outside or leaving:
                     retracked = True
+                    late = late or outside
                     if self.cfg.track_freq:
-                        seg.f0 = f0
+                        seg.f0 = float(f0)
                     if self.cfg.track_span:
-                        seg.span = bw*self.cfg.get_bw_factor()
+                        seg.span = float(bw*factor)
+                    seg.bw = float(bw)
             if retracked:
+                if late and self.budget is not None:
+                    self.budget.trouble = True
                 self.forced_retrack = False
-                self.driver.set_segments(self.cfg.segments)
-                self.driver.trigger(self.cfg.use_markers, force=True)
-
-        # Sleep to use up remaining duration in sample_interval
-        self.next_call += timedelta(seconds=self.cfg.sample_interval)
-        sleepytime = (self.next_call - datetime.now(timezone.utc)).total_seconds()
-        if sleepytime > 0.0:
-            time.sleep(sleepytime)
-
-        return sampletime, data
+                self.upload_segments()
+                self.retrack_upload = True
+                self.retrack_stats['retracks'] += 1
+                # A pipelined sweep is already running on the old window, so
+                # the new one only reaches the sweep after it, whose sample is
+                # tagged as retracked. Otherwise the next sample may be the
+                # first on the new window, and is tagged as retracked.
+                if late and not self.pipelined and self.cfg.retrack_sweep:
+                    self.flush_segments()
+                    started = time.perf_counter()
+                    self.driver.trigger(self.cfg.use_markers, force=True)
+                    self.retrack_stats['forced_sweeps'] += 1
+                    self.retrack_stats['time'] += time.perf_counter() - started
+
+    def predict_window(self, seg, t, f0, bw, outside=False):
+        """
+        Update the drift model of a segment with a new fit
+
+        Returns the f0 and bw to place the window on, and whether the
+        resonance is expected to leave the current window by the next sample.
+        The window is placed ahead of the drift, so that the resonance
+        crosses it from one side to the other before it has to move again.
+        If the resonance is already outside the window, or has stepped more
+        than DRIFT_STEP_BW bandwidths from its prediction, the model restarts
+        from the fit and the window is placed on it.
+        """
+        if seg.drift is not None:
+            step = abs(f0 - seg.drift[0].predict(t))
+            if outside or step > DRIFT_STEP_BW*bw:
+                seg.drift = None
+        if seg.drift is None:
+            seg.drift = (DriftFilter(t, f0, bw), DriftFilter(t, bw, bw))
+        f0_filter, bw_filter = seg.drift
+        f0_filter.update(t, f0)
+        bw_filter.update(t, bw)
+
+        factor = self.cfg.get_bw_factor()
+        upcoming = t + self.sample_period
+        next_f0 = f0_filter.predict(upcoming)
+        next_bw = max(bw_filter.predict(upcoming), 0.0)
+        trackf, tracks = track_window(seg.f0, seg.span, next_f0, next_bw,
+                                      bw_factor=factor)
+        leaving = (trackf and self.cfg.track_freq) or (tracks and self.cfg.track_span)
+
+        f0, velocity = f0_filter.x
+        bw = max(bw_filter.x[0], 0.0)
+        span = bw*factor if self.cfg.track_span else seg.span
+        # How far the resonance can be from the center, as in track_window
+        tolerance = span*0.25 - bw/2
+        if tolerance > 0.0 and abs(velocity) > 2.0*f0_filter.velocity_std():
+            f0 += math.copysign(0.8*tolerance, velocity)
+        return f0, bw, leaving
+
+    def get_driver_stats(self):
+        """Number of retracks, forced sweeps and searches, and their time"""
+        return dict(self.retrack_stats)
+
+    def upload_segments(self):
+        """
+        Mark the segment table to be sent to the instrument
+
+        flush_segments sends it before the next sweep starts, so any number
+        of changes in between cost at most one upload.
+        """
+        self.segments_dirty = True
+
+    def flush_segments(self):
+        """Send the segment table if it has changed since it was last sent"""
+        if self.segments_dirty:
+            started = time.perf_counter()
+            self.segments_dirty = False
+            changed = [self.driver.set_segments(segments, channel)
+                       for channel, segments in enumerate(self.channel_segments(), 1)]
+            if self.retrack_upload:
+                self.retrack_upload = False
+                self.retrack_stats['time'] += time.perf_counter() - started
+            self.table = [(seg.points, seg.ifbw) if seg.enabled else None
+                          for seg in self.cfg.segments]
+            if any(changed):
+                self.generation += 1
 
     def cleanup(self):
+        if self.pipelined:
+            self.driver.wait_sweep()
+        if self.pool is not None:
+            self.collect_fits(wait=True)
+            self.pool.shutdown()
+            self.pool = None
         self.driver.cleanup()
 
     def get_headers(self):
         h = ["Frequency {}/Hz".format(s.name) for s in self.cfg.segments]
         h += ["Q factor {}".format(s.name) for s in self.cfg.segments]
         h += ["Insertion loss {}/dB".format(s.name) for s in self.cfg.segments]
+        if self.budget_enabled():
+            h += ["Points {}".format(s.name) for s in self.cfg.segments]
+            h += ["IFBW {}/Hz".format(s.name) for s in self.cfg.segments]
         return h
 
+    def budget_enabled(self):
+        return self.cfg.target_rate > 0.0 and not self.cfg.use_markers
+
     def format_sample(self, data):
-        items = [data.f0, data.q, data.il]
+        # Segments without a fit are logged as blanks
+        items = [[None if math.isnan(x) else x for x in values]
+                 for values in data.values[:, 1:4].T.tolist()]
+        if self.budget_enabled():
+            settings = data.settings or [(None, None)]*len(data.f0)
+            items.append([points for points, ifbw in settings])
+            items.append([ifbw for points, ifbw in settings])
         if self.cfg.verbose_logging:
             for item in data.freq:
                 if item is not None:
@@ -399,31 +1039,69 @@ class Driver(Instrument):
         result = itertools.chain(*items)
         return result
 
-    @runlater
+    def sample_layout(self):
+        n = len(self.cfg.segments)
+        # The budget only ever lowers the points of a segment
+        points = sum(s.points_default for s in self.cfg.segments)
+        return n*7 + 2, points*2 + n*2
+
+    def pack_sample(self, data):
+        # Sweep settings then traces are encoded with NaN for None
+        n = len(data.values)
+        settings = data.settings or [(None, None)]*n
+        scalars = np.concatenate((
+            data.values.ravel(), [data.retracked, data.settings is not None],
+            np.array(settings, dtype=float).ravel()))
+        if data.trace_freq is None:
+            return scalars, None
+        bounds = np.array([b if b is not None else (np.nan, np.nan)
+                           for b in data.bounds], dtype=float).ravel()
+        return scalars, np.concatenate((bounds, data.trace_freq, data.trace_ampl))
+
+    def unpack_sample(self, scalars, trace):
+        n = len(self.cfg.segments)
+        data = Sample(n)
+        data.values[:] = scalars[:n*5].reshape(n, 5)
+        data.retracked = bool(scalars[n*5])
+        if scalars[n*5+1]:
+            data.settings = [(None, None) if math.isnan(points) else (int(points), ifbw)
+                             for points, ifbw in scalars[n*5+2:n*7+2].reshape(n, 2).tolist()]
+        if trace is not None:
+            bounds = trace[:n*2].reshape(n, 2).tolist()
+            data.bounds = [None if math.isnan(a) else (int(a), int(b)) for a, b in bounds]
+            points = (len(trace) - n*2)//2
+            data.trace_freq = trace[n*2:n*2+points]
+            data.trace_ampl = trace[n*2+points:]
+        return data
+
+    @runlater(key=lambda segment, enabled: ('segment_enabled', segment))
     def set_segment_enabled(self, segment, enabled):
         self.cfg.segments[segment].enabled = enabled
-        self.driver.set_segments(self.cfg.segments)
+        self.upload_segments()
 
-    @runlater
+    @runlater(key='bw_factor_override')
     def set_bw_factor_override(self, factor):
         self.cfg.bw_factor_override = factor
 
-    @runlater
+    @runlater(key='tracking_override')
     def set_tracking_override(self, enabled):
         self.cfg.track_enabled = enabled
 
-    @runlater
+    @runlater(key='reset_segments')
     def reset_segments(self):
         for segment in self.cfg.segments:
             segment.f0 = segment.f0_default
             segment.span = segment.span_default
-        self.driver.set_segments(self.cfg.segments)
+            segment.fit = None
+            segment.bw = None
+            segment.drift = None
+        self.upload_segments()
 
-    @runlater
+    @runlater(key='force_retrack')
     def force_retrack(self):
         self.forced_retrack = True
 
-    @runlater
+    @runlater(key='verbose_logging', mirror=True)
     def set_verbose_logging(self, enabled):
         self.cfg.verbose_logging = enabled
 
@@ -431,14 +1109,29 @@ class VNAState(object):
     def __init__(self, config):
         self.segments = []
         for n, s in config.segments.items():
-            self.segments.append(Segment(n, s.f0, s.span, s.points,
-                                         s.ifbw, s.power))
+            # Plain values, as the schema types carry references to the
+            # whole configuration tree
+            self.segments.append(Segment(n, float(s.f0), float(s.span),
+                                         int(s.points), float(s.ifbw),
+                                         float(s.power)))
         self.segments.sort(key=lambda seg: seg.f0)
-        self.track_freq = config.track_frequency
-        self.track_span = config.track_span
-        self.use_markers = config.use_markers
-        self.bw_factor = config.bandwidth_factor
-        self.sample_interval = config.sample_interval
+        self.track_freq = bool(config.track_frequency)
+        self.track_span = bool(config.track_span)
+        self.use_markers = bool(config.use_markers)
+        self.bw_factor = float(config.bandwidth_factor)
+        self.sample_interval = float(config.sample_interval)
+        self.sample_overrun = str(config.sample_overrun)
+        self.fit_mode = str(config.fit_mode)
+        self.fit_workers = int(config.fit_workers)
+        self.freq_check_interval = int(config.freq_check_interval)
+        self.pipeline_sweeps = bool(config.pipeline_sweeps)
+        self.channels = int(config.channels)
+        self.target_rate = float(config.target_rate)
+        self.sweep_shape = str(config.sweep_shape)
+        self.track_mode = str(config.track_mode)
+        self.search_span = float(config.search_span)
+        self.search_points = int(config.search_points)
+        self.retrack_sweep = bool(config.retrack_sweep)
         self.bw_factor_override = None
         self.track_enabled = True
         self.verbose_logging = False
@@ -455,10 +1148,16 @@ class Segment(object):
         self.name = name
         self.f0 = self.f0_default = f0
         self.span = self.span_default = span
-        self.points = points
-        self.ifbw = ifbw
+        self.points = self.points_default = points
+        self.ifbw = self.ifbw_default = ifbw
         self.power = power
         self.enabled = True
+        # Last good (f0, bw, pmax, skew), used to warm start the next fit
+        self.fit = None
+        # Bandwidth when the window was last moved, used to shape the sweep
+        self.bw = None
+        # DriftFilters for f0 and bw when tracking predictively
+        self.drift = None
 
     def copy(self):
         copy = Segment(self.name, self.f0_default, self.span_default,
@@ -466,43 +1165,232 @@ class Segment(object):
         copy.enabled = self.enabled
         copy.f0 = self.f0
         copy.span = self.span
+        copy.points_default = self.points_default
+        copy.ifbw_default = self.ifbw_default
+        copy.bw = self.bw
         return copy
 
 
 class Sample(object):
-    def __init__(self):
-        self.bw = []
-        self.f0 = []
-        self.q = []
-        self.il = []
-        self.skew = []
-        self.freq = []
-        self.ampl = []
-
-    def add_segment(self, bw, f0, q, il, skew=0.0, freq=None, ampl=None):
-        self.bw.append(bw)
-        self.f0.append(f0)
-        self.q.append(q)
-        self.il.append(il)
-        self.skew.append(skew)
-        self.freq.append(freq)
-        self.ampl.append(ampl)
+    """
+    Fits of one sweep
+
+    values holds (bw, f0, q, il, skew) for each segment, with NaN for
+    segments that were not fitted. The traces are kept whole with the
+    bounds of each segment, and freq and ampl give views into them.
+    """
+    __slots__ = ('values', 'trace_freq', 'trace_ampl', 'bounds', 'settings',
+                 'retracked')
+
+    def __init__(self, segments):
+        self.values = np.full((segments, 5), np.nan)
+        self.trace_freq = None
+        self.trace_ampl = None
+        self.bounds = None
+        # Swept (points, ifbw) of each segment, if known
+        self.settings = None
+        # First sample after the segment table changed
+        self.retracked = False
+
+    def set_segment(self, index, bw, f0, q, il, skew=0.0):
+        self.values[index] = (bw, f0, q, il, skew)
+
+    def set_traces(self, freq, ampl, bounds):
+        """Keep the traces, bounds is (start, stop) or None for each segment"""
+        self.trace_freq = freq
+        self.trace_ampl = ampl
+        self.bounds = bounds
+
+    bw = property(lambda self: self.values[:, 0])
+    f0 = property(lambda self: self.values[:, 1])
+    q = property(lambda self: self.values[:, 2])
+    il = property(lambda self: self.values[:, 3])
+    skew = property(lambda self: self.values[:, 4])
+
+    @property
+    def freq(self):
+        return self.trace_views(self.trace_freq)
+
+    @property
+    def ampl(self):
+        return self.trace_views(self.trace_ampl)
+
+    def trace_views(self, trace):
+        if trace is None:
+            return [None]*len(self.values)
+        return [trace[b[0]:b[1]] if b is not None else None for b in self.bounds]
 
     def __eq__(self, other):
-        if self.bw != other.bw:
-            return False
-        if self.f0 != other.f0:
+        if not isinstance(other, Sample):
+            return NotImplemented
+        if not np.array_equal(self.values[:, :4], other.values[:, :4], equal_nan=True):
             return False
-        if self.q != other.q:
-            return False
-        if self.il != other.il:
-            return False
-        if self.freq != other.freq:
+        for mine, theirs in ((self.trace_freq, other.trace_freq),
+                             (self.trace_ampl, other.trace_ampl)):
+            if mine is None or theirs is None:
+                if mine is not theirs:
+                    return False
+            elif not np.array_equal(mine, theirs):
+                return False
+        return self.bounds == other.bounds
+
+
+class SweepBudget(object):
+    """
+    Scales the points and IF bandwidth of the segments towards a target rate
+
+    At a scale of 1 the configured points and IF bandwidth are swept. Lower
+    scales take fewer points at a wider IF bandwidth, so the sweep time goes
+    roughly with the square of the scale. The scale is lowered while samples
+    take longer than the target rate allows and the fits are good. It is
+    raised again when fit residuals grow, a segment retracks or track is
+    lost, and when there is time to spare. IF bandwidths are rounded to the
+    nearest the instrument allows, from ifbw_steps times a power of ten.
+    """
+    min_scale = 0.25
+    min_points = 21
+    # RMS fit residual relative to the peak amplitude
+    max_residual = 0.02
+    step = 0.85
+    # Samples between adjustments
+    holdoff = 5
+
+    def __init__(self, target_rate, ifbw_steps=IFBW_STEPS):
+        self.target_rate = target_rate
+        self.ifbw_steps = ifbw_steps
+        self.scale = 1.0
+        self.busy = None
+        self.count = 0
+        self.trouble = False
+
+    def observe_fit(self, freq, ampl, f0, bw, pmax, skew):
+        residual = ampl - lorentz_fn(freq, f0, bw, pmax, skew)
+        if np.sqrt(np.mean(residual**2)) > self.max_residual*pmax:
+            self.trouble = True
+
+    def update(self, busy):
+        """Record the time taken by one sample, returns True if rescaled"""
+        if self.busy is None:
+            self.busy = busy
+        else:
+            self.busy = 0.8*self.busy + 0.2*busy
+        self.count += 1
+        if self.count < self.holdoff:
             return False
-        if self.ampl != other.ampl:
+        self.count = 0
+        trouble, self.trouble = self.trouble, False
+        load = self.busy*self.target_rate
+        scale = self.scale
+        if trouble:
+            scale = min(1.0, scale/self.step)
+        elif load > 1.0:
+            scale = max(self.min_scale, scale*self.step)
+        elif load < self.step**2:
+            scale = min(1.0, scale/self.step)
+        if scale == self.scale:
             return False
+        self.scale = scale
         return True
 
+    def apply(self, segments):
+        for seg in segments:
+            points = int(round(seg.points_default*self.scale))
+            seg.points = max(points, min(self.min_points, seg.points_default))
+            seg.ifbw = round_to_steps(seg.ifbw_default*seg.points_default/seg.points,
+                                      self.ifbw_steps)
+
+
+def round_to_steps(value, steps):
+    """The nearest on a log scale of steps times a power of ten"""
+    decade = math.floor(math.log10(value))
+    candidates = [float('{}e{}'.format(step, d)) for step in steps
+                  for d in (decade-1, decade, decade+1)]
+    return min(candidates, key=lambda x: abs(math.log(x/value)))
+
+
+SWEEP_SHAPES = ('linear', 'focused')
+# Relative change in fitted bandwidth that reshapes a focused sweep
+FOCUS_BW_TOLERANCE = 0.25
+
+def sweep_rows(seg, shape='linear', focus=4.0):
+    """
+    Segment table rows of (f0, span, points, ifbw, power) sweeping a segment
+
+    A focused sweep is split into a core within bw of the center and the
+    tails either side of it, with the points in the core focus times as
+    dense as in the tails. It needs the bandwidth from the last retrack, so
+    the sweep is linear until then. The rows never share a frequency point
+    and always add up to seg.points.
+    """
+    linear = [(seg.f0, seg.span, seg.points, seg.ifbw, seg.power)]
+    if shape != 'focused' or seg.bw is None:
+        return linear
+    start = seg.f0 - seg.span/2.0
+    stop = seg.f0 + seg.span/2.0
+    low = max(start, seg.f0 - seg.bw)
+    high = min(stop, seg.f0 + seg.bw)
+    weight = (high - low)*focus
+    tails = (low - start) + (stop - high)
+    if tails <= 0.0:
+        return linear
+    core = int(round(seg.points*weight/(weight + tails)))
+    lower = int(round((seg.points - core)*(low - start)/tails))
+    upper = seg.points - core - lower
+    if min(core, lower, upper) < 2:
+        return linear
+    # Each tail stops one of its own steps short of the core
+    lower_stop = low - (low - start)/lower
+    upper_start = high + (stop - high)/upper
+    bounds = [(start, lower_stop, lower), (low, high, core),
+              (upper_start, stop, upper)]
+    return [((a + b)/2.0, b - a, n, seg.ifbw, seg.power) for a, b, n in bounds]
+
+
+TRACK_MODES = ('reactive', 'predictive')
+# Change in bandwidths from the predicted frequency that restarts the drift
+# model, as a step is not a drift
+DRIFT_STEP_BW = 3.0
+
+class DriftFilter(object):
+    """
+    Constant velocity Kalman filter following a drifting value
+
+    The noise levels are relative to scale, the size of the value that
+    matters, such as the bandwidth for a resonant frequency.
+    """
+    # Standard deviation of a measurement
+    measurement_noise = 0.02
+    # Standard deviation of the change in velocity over one second
+    process_noise = 0.05
+
+    def __init__(self, t, value, scale):
+        self.t = t
+        self.x = np.array([value, 0.0])
+        self.r = (self.measurement_noise*scale)**2
+        self.q = (self.process_noise*scale)**2
+        # Nothing is known about the velocity yet
+        self.p = np.diag([self.r, scale**2])
+
+    def advance(self, t):
+        """The state and its covariance at time t"""
+        dt = t - self.t
+        f = np.array([[1.0, dt], [0.0, 1.0]])
+        q = self.q*np.array([[dt**3/3, dt**2/2], [dt**2/2, dt]])
+        return f @ self.x, f @ self.p @ f.T + q
+
+    def update(self, t, value):
+        x, p = self.advance(t)
+        gain = p[:, 0]/(p[0, 0] + self.r)
+        self.x = x + gain*(value - x[0])
+        self.p = p - np.outer(gain, p[0])
+        self.t = t
+
+    def predict(self, t):
+        return self.advance(t)[0][0]
+
+    def velocity_std(self):
+        return math.sqrt(self.p[1, 1])
+
 
 def track_window(center, span, f0, bw, center_err=0.5,
                  span_err=0.3, bw_factor=8.0):
@@ -517,23 +1405,277 @@ def track_window(center, span, f0, bw, center_err=0.5,
 def lorentz_fn(x, f0, bw, pmax, skew=0.0):
     return (pmax + skew*(x-f0))/np.sqrt(1 + (4*((x-f0)/bw)**2))
 
-def lorentz_fit(freq, ampl, f0=0.5, bw=0.5, pmax=1.0, skew=0.0):
-
+def lorentz_jac(x, f0, bw, pmax, skew=0.0):
+    """Jacobian of lorentz_fn with respect to (f0, bw, pmax, skew)"""
+    dx = x-f0
+    u = 2*dx/bw
+    inv = 1/np.sqrt(1 + u*u)
+    num = (pmax + skew*dx)*inv**3
+    jac = np.empty((len(x), 4))
+    jac[:, 0] = num*u*2/bw - skew*inv
+    jac[:, 1] = num*u*u/bw
+    jac[:, 2] = inv
+    jac[:, 3] = dx*inv
+    return jac
+
+def lorentz_guess(freq, ampl):
+    """Estimate (f0, bw, pmax) from the peak and its half-power width"""
+    peak = np.argmax(ampl)
+    pmax = ampl[peak]
+    below = ampl < pmax/math.sqrt(2)
+    left = np.flatnonzero(below[:peak])
+    right = np.flatnonzero(below[peak:])
+    lower = freq[left[-1]] if len(left) else freq[0]
+    upper = freq[peak+right[0]] if len(right) else freq[-1]
+    # Never guess narrower than the point spacing
+    bw = max(upper-lower, (freq[-1]-freq[0])/len(freq))
+    return freq[peak], bw, pmax
+
+def find_resonance(freq, ampl, threshold=6.0):
+    """
+    Locate the strongest resonance in a wide trace
+
+    Returns (f0, bw, pmax) as lorentz_guess does, or None if no peak stands
+    out from the background by threshold times its spread.
+    """
+    freq = np.asarray(freq)
+    ampl = np.asarray(ampl)
+    if len(ampl) < 3:
+        return None
+    # Average neighbouring points so a single noisy point is not a peak
+    smooth = np.convolve(ampl, np.ones(3)/3, mode='same')
+    smooth[0] = ampl[0]
+    smooth[-1] = ampl[-1]
+    background = np.median(smooth)
+    spread = 1.4826*np.median(np.abs(smooth - background))
+    peak = np.argmax(smooth)
+    if smooth[peak] - background <= threshold*spread:
+        return None
+    return lorentz_guess(freq, smooth)
+
+def lorentz_fit(freq, ampl, f0=None, bw=None, pmax=None, skew=0.0, jac=lorentz_jac):
+    """
+    Fit a skewed Lorentzian to a magnitude trace
+
+    The initial guess is given in the same units as the result, with pmax as
+    a linear amplitude. Any of f0, bw or pmax left as None is estimated from
+    the data. Pass jac=None to fall back to a finite difference Jacobian.
+    """
     freq = np.array(freq)
     ampl = np.array(ampl)
+    if f0 is None or bw is None or pmax is None:
+        guess = lorentz_guess(freq, ampl)
+        f0 = guess[0] if f0 is None else f0
+        bw = guess[1] if bw is None else bw
+        pmax = guess[2] if pmax is None else pmax
     maxa = np.max(ampl)
     norma = ampl/maxa
-    weights = norma*norma
 
     minf = np.min(freq)
     maxf = np.max(freq)
     fspan = maxf-minf
     normf = (freq-minf)/fspan
-    a1=0.0
-    (f0, bw, pmax, skew), pcov = curve_fit(lorentz_fn, normf, norma,
-                                     (f0, bw, pmax, skew))
+    p0 = ((f0-minf)/fspan, bw/fspan, pmax/maxa, skew*fspan/maxa)
+    (f0, bw, pmax, skew), pcov = curve_fit(lorentz_fn, normf, norma, p0, jac=jac)
     f0 = (f0*fspan)+minf
     bw = np.fabs(bw)*fspan
     skew = (skew/fspan)*maxa
     pmax = 20*np.log10(pmax*maxa)
     return bw, f0, f0/bw, pmax, skew
+
+def lorentz_fit_algebraic(freq, ampl):
+    """
+    Fit a symmetric Lorentzian with a single linear least-squares solve
+
+    1/ampl**2 is a quadratic in frequency, so f0, bw and pmax follow directly
+    from its coefficients. Rows are weighted by ampl**3 so that every point
+    carries roughly the same amplitude noise. Skew is always zero.
+    """
+    freq = np.asarray(freq, dtype=np.float64)
+    ampl = np.asarray(ampl, dtype=np.float64)
+    maxa = np.max(ampl)
+    norma = ampl/maxa
+
+    minf = np.min(freq)
+    fspan = np.max(freq)-minf
+    normf = (freq-minf)/fspan
+
+    w = norma**3
+    A = np.column_stack((normf*normf*w, normf*w, w))
+    (a, b, c), _, _, _ = np.linalg.lstsq(A, norma, rcond=None)
+    if a <= 0:
+        raise RuntimeError("Algebraic fit found no resonance")
+    f0 = -b/(2*a)
+    inv_pmax2 = c - a*f0*f0
+    if inv_pmax2 <= 0:
+        raise RuntimeError("Algebraic fit found no resonance")
+
+    pmax = 1/math.sqrt(inv_pmax2)
+    bw = 2*math.sqrt(inv_pmax2/a)*fspan
+    f0 = (f0*fspan)+minf
+    pmax = 20*np.log10(pmax*maxa)
+    return bw, f0, f0/bw, pmax, 0.0
+
+def _lorentz_batch(x, p):
+    """
+    Evaluate lorentz_fn and its Jacobian for a (segments, points) batch
+
+    The Jacobian has shape (segments, 4, points).
+    """
+    f0, bw, pmax, skew = (p[:, i, np.newaxis] for i in range(4))
+    dx = x-f0
+    u = 2*dx/bw
+    inv = 1/np.sqrt(1 + u*u)
+    num = pmax + skew*dx
+    jac = np.empty((x.shape[0], 4, x.shape[1]))
+    cube = num*inv**3*u/bw
+    jac[:, 0] = 2*cube - skew*inv
+    jac[:, 1] = cube*u
+    jac[:, 2] = inv
+    jac[:, 3] = dx*inv
+    return num*inv, jac
+
+def lorentz_fit_batch(traces, guesses=None, max_iter=50, xtol=1e-8, ftol=1e-8):
+    """
+    Fit a skewed Lorentzian to several traces with one Levenberg-Marquardt loop
+
+    traces is a list of (freq, ampl) pairs, which are normalised and stacked
+    into zero padded arrays. guesses is an optional list of (f0, bw, pmax,
+    skew) tuples in physical units, with None entries estimated from the data.
+    Each trace stops iterating independently once it converges. Returns a
+    list of (bw, f0, q, il, skew) tuples in the same order as traces, with
+    None for traces that did not converge.
+    """
+    count = len(traces)
+    if count == 0:
+        return []
+    if guesses is None:
+        guesses = [None]*count
+    width = max(len(f) for f, a in traces)
+    x = np.zeros((count, width))
+    y = np.zeros((count, width))
+    mask = np.zeros((count, width))
+    minf = np.empty(count)
+    fspan = np.empty(count)
+    maxa = np.empty(count)
+    p = np.empty((count, 4))
+    for k, ((freq, ampl), guess) in enumerate(zip(traces, guesses)):
+        freq = np.asarray(freq, dtype=np.float64)
+        ampl = np.asarray(ampl, dtype=np.float64)
+        if guess is None:
+            guess = lorentz_guess(freq, ampl) + (0.0,)
+        n = len(freq)
+        minf[k] = np.min(freq)
+        fspan[k] = np.max(freq)-minf[k]
+        maxa[k] = np.max(ampl)
+        x[k, :n] = (freq-minf[k])/fspan[k]
+        y[k, :n] = ampl/maxa[k]
+        mask[k, :n] = 1.0
+        f0, bw, pmax, skew = guess
+        p[k] = ((f0-minf[k])/fspan[k], bw/fspan[k], pmax/maxa[k],
+                skew*fspan[k]/maxa[k])
+
+    lam = np.full(count, 1e-3)
+    active = np.ones(count, dtype=bool)
+    converged = np.zeros(count, dtype=bool)
+    model, jac = _lorentz_batch(x, p)
+    resid = (model-y)*mask
+    cost = np.sum(resid*resid, axis=1)
+    eye = np.eye(4)
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+        J = jac[idx]*mask[idx, np.newaxis, :]
+        JTJ = J @ J.transpose(0, 2, 1)
+        grad = (J @ resid[idx, :, np.newaxis])[..., 0]
+        damp = lam[idx, np.newaxis, np.newaxis]*(JTJ*eye) + 1e-15*eye
+        with np.errstate(all='ignore'):
+            delta = -np.linalg.solve(JTJ + damp, grad[..., np.newaxis])[..., 0]
+            trial = p[idx]+delta
+            tmodel, tjac = _lorentz_batch(x[idx], trial)
+            tresid = (tmodel-y[idx])*mask[idx]
+            tcost = np.sum(tresid*tresid, axis=1)
+
+        better = tcost < cost[idx]
+        acc = idx[better]
+        small_step = np.all(np.abs(delta[better]) <= xtol*(np.abs(trial[better])+xtol), axis=1)
+        small_gain = cost[acc]-tcost[better] <= ftol*cost[acc]
+        p[acc] = trial[better]
+        jac[acc] = tjac[better]
+        resid[acc] = tresid[better]
+        cost[acc] = tcost[better]
+        lam[acc] *= 0.1
+        lam[idx[~better]] *= 10.0
+        done = acc[small_step | small_gain]
+        # Damping has grown so large that no step can reduce the cost
+        stuck = idx[~better][lam[idx[~better]] > 1e16]
+        converged[done] = True
+        converged[stuck] = True
+        active[done] = False
+        active[stuck] = False
+
+    results = []
+    for k in range(count):
+        f0, bw, pmax, skew = p[k]
+        if not converged[k] or not np.all(np.isfinite(p[k])) or bw == 0:
+            results.append(None)
+            continue
+        f0 = (f0*fspan[k])+minf[k]
+        bw = np.fabs(bw)*fspan[k]
+        skew = (skew/fspan[k])*maxa[k]
+        pmax = 20*np.log10(pmax*maxa[k])
+        results.append((bw, f0, f0/bw, pmax, skew))
+    return results
+
+FIT_MODES = ('full', 'algebraic', 'algebraic_refine', 'batch')
+
+def fit_resonance(freq, ampl, mode='full', guess=()):
+    """
+    Fit a resonance using the selected engine
+
+    'full' runs lorentz_fit from guess, 'algebraic' uses lorentz_fit_algebraic
+    alone and 'algebraic_refine' uses the algebraic result as the starting
+    point for lorentz_fit.
+    """
+    if mode == 'full':
+        return lorentz_fit(freq, ampl, *guess)
+    bw, f0, q, il, skew = lorentz_fit_algebraic(freq, ampl)
+    if mode == 'algebraic':
+        return bw, f0, q, il, skew
+    elif mode == 'algebraic_refine':
+        return lorentz_fit(freq, ampl, f0, bw, 10.0**(il/20.0), skew)
+    raise ValueError("Unknown fit mode '{}'".format(mode))
+
+def fit_sweep(freq, ampl, segments, mode='full'):
+    """
+    Fit every segment of a sweep
+
+    segments is a list of (points, guess) pairs, or None for segments that
+    are disabled and so absent from the sweep. Returns a list with a
+    (bw, f0, q, il, skew) tuple for each segment, or None where the segment
+    is disabled or the fit failed. The 'batch' mode fits all segments
+    together with lorentz_fit_batch, any other mode is passed to
+    fit_resonance one segment at a time.
+    """
+    traces = []
+    start = 0
+    for seg in segments:
+        if seg is not None:
+            points, guess = seg
+            traces.append((freq[start:start+points], ampl[start:start+points], guess))
+            start += points
+
+    if mode == 'batch':
+        fits = iter(lorentz_fit_batch([(f, a) for f, a, g in traces],
+                                      [g for f, a, g in traces]))
+    else:
+        def fit_each():
+            for f, a, guess in traces:
+                try:
+                    yield fit_resonance(f, a, mode, guess or ())
+                except (RuntimeError, ValueError):
+                    yield None
+        fits = fit_each()
+    return [next(fits) if seg is not None else None for seg in segments]
+
@@ -0,0 +1,315 @@
+"""
+Local stand-in for a network analyser speaking SCPI over a raw socket
+
+The E5071X and N5232A drivers in vna.driver can connect to it unchanged
+by using a resource name of the form TCPIP::127.0.0.1::<port>::SOCKET.
+It understands the short form commands those drivers send: the segment
+tables and edits to single segments, triggering, completion through *OPC?
+or the status registers, trace and frequency data in ASCII or binary,
+and the bandwidth markers. Responses are generated by the Simulated
+model. Each query can be delayed to mimic LAN latency, and sweeps take
+a time proportional to their number of points.
+
+Run it from the repository root with:
+
+    python -m vna.simserver [--port PORT] [--latency S] [--point-time S]
+
+Without NI-VISA installed, select the pyvisa-py backend on the client
+side with PYVISA_LIBRARY=@py.
+"""
+import argparse
+import math
+import re
+import socket
+import socketserver
+import threading
+import time
+import numpy as np
+
+from .driver import Simulated, Segment, lorentz_guess
+
+
+class SimulatedVNA(object):
+    """Instrument state shared by every connection to the server"""
+    def __init__(self, latency=0.0, point_time=0.0):
+        self.latency = latency
+        self.point_time = point_time
+        self.lock = threading.Lock()
+        self.commands = [
+            (r'\*IDN\?', self.idn),
+            (r'\*RST', self.reset),
+            (r'\*OPC\?', self.opc),
+            (r'\*OPC', self.set_opc),
+            (r'\*ESR\?', self.event_status),
+            (r'\*STB\?', self.status_byte),
+            (r'\*ESE (\d+)', self.set_event_enable),
+            (r'\*SRE (\d+)', self.set_request_enable),
+            (r'\*CLS', self.clear_status),
+            (r'FORM:DATA (\S+)', self.set_format),
+            (r'FORM:BORD (\S+)', self.set_byte_order),
+            (r'TRIG:SING', self.start_sweep),
+            (r'INIT:IMM', self.start_sweep),
+            (r'SENS(\d+):SWE:TIME\?', self.sweep_time),
+            (r'SENS(\d+):SEGM:DATA (.*)', self.set_segment_data),
+            (r'SENS(\d+):SEGM:LIST (.*)', self.set_segment_list),
+            (r'SENS(\d+):SEGM(\d+):FREQ:CENT (\S+)', self.set_segment_center),
+            (r'SENS(\d+):SEGM(\d+):FREQ:SPAN (\S+)', self.set_segment_span),
+            (r'CALC(\d+):DATA:SDAT\?', self.sweep_data),
+            (r'CALC(\d+):DATA\? SDAT', self.sweep_data),
+            (r'SENS(\d+):FREQ:DATA\?', self.freq_data),
+            (r'CALC(\d+):X\?', self.freq_data),
+            (r'CALC(\d+):MARK(\d+):BWID:DATA\?', self.marker_data),
+        ]
+        self.commands = [(re.compile(pattern, re.S), fn)
+                         for pattern, fn in self.commands]
+        self.reset()
+
+    def reset(self):
+        self.binary = False
+        self.big_endian = True
+        self.sweep_end = 0.0
+        self.event_enable = 0
+        self.request_enable = 0
+        self.clear_status()
+        self.model = Simulated(None)
+        self.model.setup(False)
+
+    def execute(self, command):
+        """Execute one command, returning the response to a query or None"""
+        command = command.strip().lstrip(':')
+        header, _, args = command.partition(' ')
+        command = header.upper() + (' ' + args if args else '')
+        with self.lock:
+            for pattern, fn in self.commands:
+                match = pattern.fullmatch(command)
+                if match:
+                    return fn(*match.groups())
+        # Settings the simulation has no use for are accepted silently
+        return None
+
+    def idn(self):
+        return b'Simulated,VNA,0,0'
+
+    def opc(self):
+        self.wait_sweep()
+        return b'1'
+
+    def set_opc(self):
+        self.opc_pending = True
+
+    def update_status(self):
+        # Operation complete is flagged once the pending sweep has ended
+        if self.opc_pending and time.time() >= self.sweep_end:
+            self.opc_pending = False
+            self.esr |= 1
+
+    def event_status(self):
+        self.update_status()
+        esr, self.esr = self.esr, 0
+        return str(esr).encode()
+
+    def status_byte(self):
+        # Only the event summary bit is simulated. There is no service
+        # request line on a raw socket, so clients have to poll for it.
+        self.update_status()
+        return str(32 if self.esr & self.event_enable else 0).encode()
+
+    def set_event_enable(self, value):
+        self.event_enable = int(value)
+
+    def set_request_enable(self, value):
+        self.request_enable = int(value)
+
+    def clear_status(self):
+        self.esr = 0
+        self.opc_pending = False
+
+    def set_format(self, fmt):
+        self.binary = fmt.upper().startswith('REAL')
+
+    def set_byte_order(self, order):
+        self.big_endian = order.upper().startswith('NORM')
+
+    def start_sweep(self):
+        self.sweep_end = time.time() + self.get_sweep_time()
+
+    def wait_sweep(self):
+        remaining = self.sweep_end - time.time()
+        if remaining > 0.0:
+            time.sleep(remaining)
+
+    def get_sweep_time(self, channel=None):
+        """Time to sweep one channel, or all of them in turn"""
+        if channel is None:
+            channels = self.model.segments.values()
+        else:
+            channels = [self.model.segments.get(channel, [])]
+        points = sum(s.points for segments in channels for s in segments if s.enabled)
+        return points*self.point_time
+
+    def sweep_time(self, channel):
+        return '{:.12E}'.format(self.get_sweep_time(int(channel))).encode()
+
+    def set_segment_data(self, channel, args):
+        data = self.parse_values(args)
+        # [<buf>,<stim>,<ifbw>,<pow>,<del>,<time>,<segm>] then
+        # <f0>,<span>,<points>,<ifbw>,<power> for each segment
+        segments = []
+        for i in range(int(data[6])):
+            f0, span, points, ifbw, power = data[7+i*5:12+i*5]
+            segments.append(Segment(str(i), f0, span, int(points), ifbw, power))
+        self.model.set_segments(segments, int(channel))
+
+    def set_segment_list(self, channel, args):
+        kind, count, *data = args.split(',')
+        # <state>,<points>,<start>,<stop>,<ifbw>,<dwell>,<power> for each
+        # segment, with center and span in place of start and stop for CSPAN
+        segments = []
+        for i in range(int(count)):
+            state, points, a, b, ifbw, dwell, power = data[i*7:i*7+7]
+            a, b = float(a), float(b)
+            if kind.strip().upper() == 'SSTOP':
+                a, b = (a+b)/2, b-a
+            segment = Segment(str(i), a, b, int(float(points)), float(ifbw),
+                              float(power))
+            segment.enabled = bool(int(float(state)))
+            segments.append(segment)
+        self.model.set_segments(segments, int(channel))
+
+    def set_segment_center(self, channel, number, value):
+        self.edit_segment(int(channel), int(number), f0=float(value))
+
+    def set_segment_span(self, channel, number, value):
+        self.edit_segment(int(channel), int(number), span=float(value))
+
+    def edit_segment(self, channel, number, **values):
+        segments = [s.copy() for s in self.model.segments.get(channel, [])]
+        segment = [s for s in segments if s.enabled][number-1]
+        for name, value in values.items():
+            setattr(segment, name, value)
+        self.model.set_segments(segments, channel)
+
+    def sweep_data(self, channel):
+        # Interleaved real and imaginary parts
+        cplx = self.model.get_sweep_data(int(channel))
+        return self.format_values(cplx.T.ravel())
+
+    def freq_data(self, channel):
+        return self.format_values(self.model.get_freq_data(int(channel)))
+
+    def marker_data(self, channel, marker):
+        """Bandwidth, center, Q and loss of the marker's segment"""
+        channel = int(channel)
+        freq = self.model.get_freq_data(channel)
+        cplx = self.model.get_sweep_data(channel)
+        ampl = np.sqrt(cplx[0]**2 + cplx[1]**2)
+        start = 0
+        enabled = [s for s in self.model.segments.get(channel, []) if s.enabled]
+        for segment in enabled[:int(marker)-1]:
+            start += segment.points
+        points = enabled[int(marker)-1].points
+        f0, bw, pmax = lorentz_guess(freq[start:start+points],
+                                     ampl[start:start+points])
+        values = [bw, f0, f0/bw, 20*math.log10(pmax)]
+        return ','.join('{:.12E}'.format(x) for x in values).encode()
+
+    def dtype(self):
+        return '>f8' if self.big_endian else '<f8'
+
+    def parse_values(self, args):
+        args = args.encode('latin-1')
+        if args.startswith(b'#'):
+            digits = int(args[1:2])
+            length = int(args[2:2+digits])
+            block = args[2+digits:2+digits+length]
+            return np.frombuffer(block, self.dtype())
+        return [float(x) for x in args.split(b',')]
+
+    def format_values(self, values):
+        if self.binary:
+            block = np.asarray(values, dtype=self.dtype()).tobytes()
+            length = str(len(block)).encode()
+            return b'#' + str(len(length)).encode() + length + block
+        return ','.join('{:.12E}'.format(x) for x in values).encode()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        vna = self.server.vna
+        while True:
+            message = self.read_message()
+            if not message:
+                break
+            responses = []
+            for command in self.split_message(message):
+                response = vna.execute(command)
+                if response is not None:
+                    responses.append(response)
+            if responses:
+                if vna.latency > 0.0:
+                    time.sleep(vna.latency)
+                self.wfile.write(b';'.join(responses) + b'\n')
+
+    def read_message(self):
+        """Read one newline terminated message, including binary blocks"""
+        message = self.rfile.readline()
+        if hasattr(socket, 'TCP_QUICKACK'):
+            # Acknowledge at once, otherwise a client with Nagle's algorithm
+            # enabled holds back a query sent straight after a write
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        block = re.search(rb'#([1-9])', message)
+        if block:
+            digits = int(block.group(1))
+            length = int(message[block.end():block.end()+digits])
+            end = block.end() + digits + length
+            # Binary data can contain newlines of its own
+            while len(message) <= end:
+                more = self.rfile.readline()
+                if not more:
+                    return b''
+                message += more
+        return message.rstrip(b'\n')
+
+    def split_message(self, message):
+        # Binary blocks may contain semicolons, so never split those
+        if re.search(rb'#[1-9]', message):
+            return [message.decode('latin-1')]
+        return message.decode('latin-1').split(';')
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 5025), latency=0.0, point_time=0.0):
+        super().__init__(address, Handler)
+        self.vna = SimulatedVNA(latency, point_time)
+
+    @property
+    def resource(self):
+        """VISA resource name for connecting to this server"""
+        host, port = self.server_address
+        return 'TCPIP::{}::{}::SOCKET'.format(host, port)
+
+    def start(self):
+        """Serve from a background thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated SCPI network analyser")
+    parser.add_argument('--port', type=int, default=5025)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="delay before each response in seconds")
+    parser.add_argument('--point-time', type=float, default=0.0,
+                        help="sweep time per point in seconds")
+    args = parser.parse_args()
+    server = Server(('127.0.0.1', args.port), args.latency, args.point_time)
+    print("Serving simulated VNA on {}".format(server.resource))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()